@@ -0,0 +1,72 @@
+import argparse
+
+import torch
+
+import ssm
+from timing import StageTimer
+
+'''
+python bench_lstm.py --data ../data_full/transformer_data_sharded --batch-size 512 --threads 8
+'''
+
+
+def run(model, loader, timer, name, train=False):
+    """Run the model over every batch of the loader, timing only the model."""
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.) if train else None
+    model.train(train)
+    for x, y, mask, lengths in loader:
+        with timer.stage(name):
+            if train:
+                output = model(x, lengths)
+                loss = output.square().mean()
+                optimizer.zero_grad()
+                loss.backward()
+            else:
+                with torch.inference_mode():
+                    model(x, lengths)
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the throughput of the padded and packed LSTM.')
+    parser.add_argument('--data', type=str, help='data set, e.g. "../data_full/transformer_data_sharded"; a compact or sharded one is expanded per batch')
+    parser.add_argument('--spec', type=str, help='target the designs are selected for', default = 'airworthy')
+    parser.add_argument('--batch-size', type=int, help='Number of designs per batch', default = 512)
+    parser.add_argument('--emsize', type=int, help='Embedding dimension', default = 200)
+    parser.add_argument('--dimension', type=int, help='Hidden size of the LSTM', default = 512)
+    parser.add_argument('--repeats', type=int, help='Number of passes over the data set of each mode, e.g. for a small data set', default = 1)
+    parser.add_argument('--threads', type=int, help='Number of torch threads, default: torch default', default = None)
+    parser.add_argument('--bucket', help="Batch designs of similar length, padded to the longest design of each batch, instead of padding to the longest design of the data set", action="store_true")
+    parser.add_argument('--train', help="Time forward and backward passes instead of inference", action="store_true")
+    parser.add_argument('--timing-json', type=str, help='Also write the report to this JSON file', default = None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    dataloader, _, _ = ssm.prepare_sequence_data(args.data, args.spec, batch_size_val=args.batch_size, frac_train=0.0,
+                                                 lazy=True, bucket=args.bucket)
+    N = len(dataloader.dataset)
+    tokens = sum(int(lengths.sum()) for _, _, _, lengths in dataloader)
+    x, _, _, _ = next(iter(dataloader))
+    model = ssm.LSTM(x.shape[-1], args.emsize, args.dimension)
+
+    timer = StageTimer()
+    for name, packed in [('padded', False), ('packed', True)]:
+        model.packed = packed
+        for _ in range(args.repeats):
+            run(model, dataloader, timer, name, args.train)
+    N *= args.repeats
+    tokens *= args.repeats
+
+    report = timer.report(designs=N, tokens=tokens, repeats=args.repeats, threads=torch.get_num_threads(), batch_size=args.batch_size,
+                          bucket=args.bucket, train=args.train)
+    print('{:<8s} {:>10s} {:>14s} {:>14s}'.format('Mode', 'wall (s)', 'designs/sec', 'tokens/sec'))
+    for name, s in report['stages'].items():
+        s['designs_per_sec'] = N / s['wall']
+        s['tokens_per_sec'] = tokens / s['wall']
+        print('{:<8s} {:>10.3f} {:>14.1f} {:>14.1f}'.format(name, s['wall'], s['designs_per_sec'], s['tokens_per_sec']))
+    print('Packed speedup: {:.2f}x'.format(report['stages']['padded']['wall'] / report['stages']['packed']['wall']))
+    if args.timing_json is not None:
+        timer.save_report(report, args.timing_json)
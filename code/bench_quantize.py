@@ -0,0 +1,99 @@
+import argparse
+import json
+
+import torch
+
+import ssm
+from predict import Predictor, quantize_dynamic
+from timing import StageTimer
+
+'''
+python bench_quantize.py --config ../models/transformer_airworthy_model_config,../models/transformer_mass_model_config --weights airworthy_weights.pt,mass_weights.pt --data ../data_full/transformer_data --threads 8
+'''
+
+
+def run(model, loader, timer, name):
+    """Outputs of the model over every batch of the loader, timing only the model, after a warm up batch."""
+    lstm = isinstance(model, ssm.LSTM)
+    outputs = []
+    with torch.inference_mode():
+        for batch, (x, y, mask, lengths) in enumerate(loader):
+            if batch == 0:
+                model(x, lengths) if lstm else model(x, mask)
+            with timer.stage(name):
+                output = model(x, lengths) if lstm else model(x, mask)
+            outputs.append(output.float().view(len(lengths), -1))
+    return torch.cat(outputs)
+
+def spec_metrics(output, y, spec, scale_1=None, scale_2=None):
+    """Accuracy of a classification spec, root mean squared error in the units of the target otherwise.
+
+    output is the model output and y the normalized targets of ssm.sequence_targets.
+    """
+    valid = ~torch.isnan(y)
+    output, y = output[valid], y[valid]
+    if spec in ssm.classification_specs:
+        return {'accuracy': ((output > 0).float() == y).float().mean().item()}
+    if spec == 'dist':
+        output = torch.selu(output)
+        units = scale_2 - scale_1
+    else:
+        units = scale_2
+    return {'rmse': ((output - y).square().mean().sqrt() * units).item()}
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the accuracy and throughput of models with float and dynamic int8 weights.')
+    parser.add_argument('--config', type=str, help='comma separated model configs, e.g. of the airworthy classifier and the regression models')
+    parser.add_argument('--weights', type=str, help='comma separated model weights, one per config, if they are not in the model configs', default = None)
+    parser.add_argument('--encoding', type=str, help='model encoding dictionary or compact data set the models were trained with', default = '../models/transformer_data_model_encoding')
+    parser.add_argument('--data', type=str, help='data set the models are evaluated on, a compact or sharded one for models with a token embedding, e.g. "../data_full/transformer_data"')
+    parser.add_argument('--frac-train', type=float, help='Fractions and seed of the split of train.py, the test set is evaluated; 0 to evaluate every design', default = 0.7)
+    parser.add_argument('--frac-val', type=float, help='Fraction of the designs used for validation', default = 0.1)
+    parser.add_argument('--seed', type=int, help='Random seed of the split', default = 0)
+    parser.add_argument('--batch-size', type=int, help='Number of designs per batch', default = 256)
+    parser.add_argument('--threads', type=int, help='Number of torch threads, default: torch default', default = None)
+    parser.add_argument('--timing-json', type=str, help='Also write the report to this JSON file', default = None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    configs = args.config.split(',')
+    weights = args.weights.split(',') if args.weights is not None else [None] * len(configs)
+
+    report = {'threads': torch.get_num_threads(), 'batch_size': args.batch_size, 'models': {}}
+    print('{:<40s} {:<12s} {:>10s} {:>10s} {:>10s} {:>14s} {:>14s} {:>8s}'.format(
+        'Model', 'spec', 'metric', 'float', 'int8', 'float des/s', 'int8 des/s', 'speedup'))
+    for config_path, weights_path in zip(configs, weights):
+        predictor = Predictor.load(config_path, args.encoding, weights_path)
+        spec = predictor.spec
+        task_specs = [spec] if isinstance(spec, str) else spec
+        ids = predictor.collate.output == 'ids'
+        loaders = ssm.prepare_sequence_data(args.data, spec, batch_size_val=args.batch_size, frac_train=args.frac_train,
+                                            frac_val=args.frac_val, lazy=ids, batch_eval=True, num_workers=0, seed=args.seed)
+        loader = loaders[0] if args.frac_train == 0. else loaders[2]
+        if ids:
+            loader.collate_fn.output = 'ids'
+        y = torch.cat([y.float().view(len(y), -1) for _, y, _, _ in loader])
+
+        timer = StageTimer()
+        outputs = {'float': run(predictor.model, loader, timer, 'float'),
+                   'int8': run(quantize_dynamic(predictor.model), loader, timer, 'int8')}
+        designs_per_sec = {name: len(y) / timer.stages[name]['wall'] for name in outputs}
+        speedup = designs_per_sec['int8'] / designs_per_sec['float']
+
+        results = {}
+        for t, s in enumerate(task_specs):
+            scales = (predictor.scale_1, predictor.scale_2) if isinstance(spec, str) else \
+                     (predictor.scale_1[s], predictor.scale_2[s])
+            results[s] = {name: spec_metrics(output[:, t], y[:, t], s, *scales) for name, output in outputs.items()}
+            metric = next(iter(results[s]['float']))
+            print('{:<40s} {:<12s} {:>10s} {:>10.4g} {:>10.4g} {:>14.1f} {:>14.1f} {:>7.2f}x'.format(
+                config_path[-40:], s, metric, results[s]['float'][metric], results[s]['int8'][metric],
+                designs_per_sec['float'], designs_per_sec['int8'], speedup))
+        report['models'][config_path] = {'designs': len(y), 'designs_per_sec': designs_per_sec, 'speedup': speedup, 'metrics': results,
+                                         'max_abs_difference': (outputs['float'] - outputs['int8']).abs().max().item()}
+    if args.timing_json is not None:
+        with open(args.timing_json, 'w') as f:
+            json.dump(report, f, indent=4)
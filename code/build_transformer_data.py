@@ -1,11 +1,19 @@
 import argparse
+import numpy as np
 import torch
 import os
 import json
-import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import design_io
+from corpus_features import comp_types, load_corpus_features
+from float_stats import FloatStats
+from timing import StageTimer
+from vocab import Vocabulary
+from ssm import CompactData
 
 '''
-python build_transformer_data.py --input ../data --save-path ../data/transformer_data 
+python build_transformer_data.py --input ../data --save-path ../data/transformer_data --workers 4
 '''
 
 
@@ -33,27 +41,226 @@ replacement_blacklist_keys = ["arm1Length", "arm2Length"]
 design_seq_start = 2 # i.e. miss out generator version and "name" in design sequence
 
 
-def encoding(all_words):
-    unique_keys   = list(set(all_words))
-    encoding_dict_keys = {}
-    numbers = []
-    i = 0
-    for k in unique_keys:
-        if isinstance(k, str):
-            encoding_dict_keys[k] = i
-            i+=1
-    return encoding_dict_keys
+def design_labels(d):
+    """Labels of a design from its output.json."""
+    return {'mass': d['Mass'],
+            'interference': d['Interferences'],
+            'hover_time': d['Hover_Time'],
+            'max_speed': d['Max_Speed'],
+            'max_distance': d['Max_Distance'],
+            'airworthy': 1 if d['Hover_Time'] else 0}
+
+def read_design_chunk(folder_paths, test=False):
+    """Read the design sequence, and the labels unless testing, of some design folders.
+
+    Returns for each folder (design_sequence, labels), where labels is None
+    when testing, or None if the folder does not hold a usable design.
+    """
+    sequences = design_io.read_many(folder_paths, 'seq')
+    if test:
+        return [None if seq is None else (seq, None) for seq in sequences]
+    outputs = design_io.read_many(folder_paths, 'output')
+    return [None if seq is None or out is None else (seq, design_labels(out))
+            for seq, out in zip(sequences, outputs)]
+
+def read_design_chunk_with_stats(folder_paths, test=False):
+    """read_design_chunk in a worker process, also returning the design_io stats of the worker."""
+    design_io.reset_stats()
+    return read_design_chunk(folder_paths, test), dict(design_io.stats)
 
-a_file = open("../data/corpus_dic", "rb")
-corpus_dic = pickle.load(a_file)
-a_file.close()
+def read_design_folders(path, design_folders, test=False, workers=1):
+    """Read all design folders, in parallel if workers > 1.
 
-Motor = torch.stack([torch.tensor(list(corpus_dic['Motor'][m].values())) for m in list(corpus_dic['Motor'].keys())])
-Battery = torch.stack([torch.tensor(list(corpus_dic['Battery'][esc].values())) for esc in list(corpus_dic['Battery'].keys())])
-Propeller = torch.stack([torch.tensor(list(corpus_dic['Propeller'][p].values())) for p in list(corpus_dic['Propeller'].keys())])
+    Results are returned in the order of design_folders, so a parallel read
+    gives exactly the same data set as a serial one. The design_io stats of
+    the workers are added to those of this process.
+    """
+    folder_paths = [os.path.join(path, folder) for folder in design_folders]
+    if workers > 1:
+        chunksize = max(1, len(folder_paths) // (workers * 16))
+        chunks = [folder_paths[i:i + chunksize] for i in range(0, len(folder_paths), chunksize)]
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk_results, stats in executor.map(read_design_chunk_with_stats, chunks, [test] * len(chunks)):
+                results.extend(chunk_results)
+                design_io.add_stats(stats)
+        return results
+    return read_design_chunk(folder_paths, test)
+
+corpus = load_corpus_features("../data/corpus_dic")
+corpus_dic = corpus.corpus_dic
 
 USE_DICT = True # Build input from all components and not just what was in the data
 
+def encode_design_compact(design, encoding_dict_keys, encoding_dict_values, float_stats=None):
+    """Encode a design sequence as token records (key id, value id, float, component row).
+
+    If float_stats is given, the floats of the design are added to it.
+    """
+    key_ids = []
+    value_ids = []
+    floats = []
+    rows = []
+    for d in design[design_seq_start:]:
+        item = list(d.items())
+        k = item[0][0]
+        v = item[0][1]
+
+        if k in blacklist_keys:
+            k = replacement_blacklist_keys[blacklist_keys.index(k)]
+
+        key_ids.append(encoding_dict_keys[k])
+        if isinstance(v, str):
+            value_ids.append(encoding_dict_values[v])
+            floats.append(0.)
+            rows.append(corpus.key_row(k, v))
+        else:
+            value_ids.append(encoding_dict_values['Value'])
+            floats.append(float(v))
+            rows.append(0)
+            if float_stats is not None:
+                float_stats.update(k, v)
+    return key_ids, value_ids, floats, rows
+
+def compact_data_set(records, encoding_dict_keys, encoding_dict_values, float_stats):
+    """Build the compact form of the data set: flat token records of all designs,
+    the offsets of each design into them and the parameters to normalize them.
+
+    records holds the output of encode_design_compact for each design, and
+    float_stats the statistics of all their floats.
+    """
+    key_ids = []
+    value_ids = []
+    floats = []
+    rows = []
+    offsets = [0]
+    for k, v, f, r in records:
+        key_ids.extend(k)
+        value_ids.extend(v)
+        floats.extend(f)
+        rows.extend(r)
+        offsets.append(len(key_ids))
+    float_shift, float_scale = float_stats.norm_params(encoding_dict_keys)
+    return {'format': 'compact',
+            'key_ids': torch.tensor(key_ids, dtype=torch.int32),
+            'value_ids': torch.tensor(value_ids, dtype=torch.int32),
+            'floats': torch.tensor(floats, dtype=torch.float32),
+            'comp_rows': torch.tensor(rows, dtype=torch.int32),
+            'offsets': torch.tensor(offsets, dtype=torch.int64),
+            'comp_attrs': corpus.attrs, 'comp_attrs_norm': corpus.attrs_norm,
+            'float_shift': float_shift, 'float_scale': float_scale,
+            'encoding_dict_keys': encoding_dict_keys, 'encoding_dict_values': encoding_dict_values,
+            'norm_dict': float_stats.state_dict()}
+
+def design_words(design_sequence_list):
+    """Keys and values of all tokens of the designs, without blacklisted keys or values."""
+    full_keys = [list(item.keys())[0] for design in design_sequence_list for item in design[design_seq_start:]]
+    full_keys = [k for k in full_keys if k not in blacklist_keys]
+    full_values = [list(item.values())[0] for design in design_sequence_list for item in design[design_seq_start:]]
+    full_values = [v for v in full_values if v not in blacklist]
+    return full_keys, full_values
+
+def build_vocab(design_sequence_list):
+    full_keys, full_values = design_words(design_sequence_list)
+    if USE_DICT:
+        # Use all components in dictionary, extended to those used in the data set:
+        comp_values = []
+        for compType in comp_types:
+            comp_values.extend(corpus.names(compType))
+        full_values = [v for v in comp_values if v not in blacklist] + full_values
+
+    # Sorted keys and values, plus the explicit float token 'Value'
+    return Vocabulary.build(full_keys, full_values)
+
+def compact_from_dense(data_set):
+    """Compact form of a dense data set, e.g. to save it sharded.
+
+    The key and value ids and the raw floats are read back from the one-hot
+    rows of X. The component table holds the distinct (raw, normalized)
+    attribute rows of the data set, and the floats are normalized with the
+    norm_dict of the build, so the expanded records equal X, and X_norm up
+    to float32 rounding.
+    """
+    K = len(data_set['encoding_dict_keys'])
+    V = len(data_set['encoding_dict_values'])
+    lengths = torch.tensor([len(x) for x in data_set['X']])
+    X = torch.cat(data_set['X'])
+    X_norm = torch.cat(data_set['X_norm'])
+    C = X.shape[-1] - K - V - 1
+    comp_attrs, comp_rows = torch.unique(torch.cat([X[:, K + V:-1], X_norm[:, K + V:-1]], 1), dim=0, return_inverse=True)
+    float_stats = FloatStats.from_state_dict(data_set['norm_dict'])
+    float_shift, float_scale = float_stats.norm_params(data_set['encoding_dict_keys'])
+    compact = {name: value for name, value in data_set.items() if name not in ['X', 'X_norm']}
+    compact.update({'format': 'compact', 'norm_dict': float_stats.state_dict(),
+                    'key_ids': X[:, :K].argmax(1).int(),
+                    'value_ids': X[:, K:K + V].argmax(1).int(),
+                    'floats': X[:, -1].clone(),
+                    'comp_rows': comp_rows.int(),
+                    'offsets': torch.cat([torch.zeros(1, dtype=torch.int64), lengths.cumsum(0)]),
+                    'comp_attrs': comp_attrs[:, :C].contiguous(), 'comp_attrs_norm': comp_attrs[:, C:].contiguous(),
+                    'float_shift': float_shift, 'float_scale': float_scale})
+    return compact
+
+def save_sharded(data_set, save_path, shard_size=4096):
+    """Save a compact data set as a directory of memory-mappable shards.
+
+    Each shard holds the flat token records of shard_size designs as .npy
+    files, plus the offsets of each design into them. The tables needed to
+    expand the records are saved as .npy files too, and everything else in
+    meta.json, so ssm.ShardedData can open the data set without reading the
+    token records.
+    """
+    os.makedirs(save_path, exist_ok=True)
+    offsets = data_set['offsets']
+    n_designs = len(offsets) - 1
+    shards = []
+    for n, first in enumerate(range(0, n_designs, shard_size)):
+        last = min(first + shard_size, n_designs)
+        start, stop = offsets[first].item(), offsets[last].item()
+        shard = 'shard_{:05d}'.format(n)
+        os.makedirs(os.path.join(save_path, shard), exist_ok=True)
+        for name in ['key_ids', 'value_ids', 'floats', 'comp_rows']:
+            np.save(os.path.join(save_path, shard, name + '.npy'), data_set[name][start:stop].numpy())
+        np.save(os.path.join(save_path, shard, 'offsets.npy'), (offsets[first:last + 1] - start).numpy())
+        shards.append(shard)
+    for name in ['comp_attrs', 'comp_attrs_norm', 'float_shift', 'float_scale']:
+        np.save(os.path.join(save_path, name + '.npy'), data_set[name].numpy())
+
+    meta = {name: value for name, value in data_set.items()
+            if name not in ['key_ids', 'value_ids', 'floats', 'comp_rows', 'offsets',
+                            'comp_attrs', 'comp_attrs_norm', 'float_shift', 'float_scale']}
+    meta.update({'format': 'sharded', 'n_designs': n_designs, 'shard_size': shard_size, 'shards': shards})
+    with open(os.path.join(save_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+manifest_version = 2
+manifest_files = ['design_seq.json', 'output.json']
+
+def folder_signature(folder_path):
+    """Size and modification time of the files a design is built from."""
+    signature = {}
+    for name in manifest_files:
+        try:
+            st = os.stat(os.path.join(folder_path, name))
+            signature[name] = (st.st_size, st.st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            signature[name] = None
+    return signature
+
+def load_manifest(manifest_path, test=False):
+    """Load the manifest of a previous build, or start an empty one.
+
+    The manifest holds, for each folder, the signature of its files, its
+    labels, its token records and the statistics of its floats, plus the
+    vocabulary (state dict) the token records are encoded with.
+    """
+    if os.path.exists(manifest_path):
+        manifest = torch.load(manifest_path)
+        if manifest.get('version') == manifest_version and manifest['test'] == test:
+            return manifest
+        print('Manifest ', manifest_path, ' is from a different kind of build, rebuilding all designs')
+    return {'version': manifest_version, 'test': test, 'folders': {}, 'vocab': None}
+
 # Main code
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run a generated design through the pipeline.')
@@ -61,6 +268,13 @@ if __name__ == "__main__":
     parser.add_argument('--save-path', type=str, help='save location, e.g. "../data/saved"')
     parser.add_argument('--model-data', type=str, help='If you have an encoding already decided, pass the path to the dictionary here', default = 'NULL')
     parser.add_argument('--test', help="If testing, we do not have labels so must build data set differently", action="store_true")
+    parser.add_argument('--workers', type=int, help='Number of processes used to read the design folders', default = 1)
+    parser.add_argument('--format', type=str, choices=['dense', 'compact', 'sharded'], help='Save dense one-hot tensors, compact token records that ssm.py expands on load, or a directory of memory-mapped shards of token records', default = 'dense')
+    parser.add_argument('--shard-size', type=int, help='Number of designs per shard of a sharded data set', default = 4096)
+    parser.add_argument('--incremental', help="Only read and encode folders that are new or changed since the last build, as recorded in the manifest", action="store_true")
+    parser.add_argument('--manifest', type=str, help='Manifest of the incremental build, default: <save-path>.manifest', default = None)
+    parser.add_argument('--vocab', type=str, help='Vocabulary file. If it exists, it is extended with new words without renumbering, otherwise it is built from the data. It is saved after the build', default = None)
+    parser.add_argument('--timing-json', type=str, help='Also write the timing report of the build to this JSON file', default = None)
     args = parser.parse_args()
     
     path = args.input
@@ -68,213 +282,121 @@ if __name__ == "__main__":
     encoding_path = args.model_data
     design_folders = os.listdir(path)
     
-    # Labels available:
-    if not args.test:
-        design_sequence_list = []
-        hover_time = []
-        max_speed = []
-        max_distance = []
-        airworthy_list = []
-        mass_list = []
-        interference_list = []
+    timer = StageTimer()
+
+    # Vocabulary to start from: given, saved by an earlier build or that of the manifest
+    vocab = None
+    if encoding_path != 'NULL':
+        vocab = Vocabulary.from_data(torch.load(encoding_path))
+    elif args.vocab is not None and os.path.exists(args.vocab):
+        vocab = Vocabulary.load(args.vocab)
+
+    manifest = None
+    to_read = design_folders
+    if args.incremental:
+        with timer.stage('manifest'):
+            manifest_path = args.manifest if args.manifest is not None else save_path + '.manifest'
+            manifest = load_manifest(manifest_path, args.test)
+            if manifest['vocab'] is not None:
+                manifest_vocab = Vocabulary.from_state_dict(manifest['vocab'])
+                if vocab is None:
+                    vocab = manifest_vocab
+                elif not vocab.extends(manifest_vocab):
+                    print('The vocabulary does not extend that of ', manifest_path, ', rebuilding all designs')
+                    manifest['folders'] = {}
+            signatures = {folder: folder_signature(os.path.join(path, folder)) for folder in design_folders}
+            to_read = [folder for folder in design_folders
+                       if folder not in manifest['folders'] or manifest['folders'][folder]['signature'] != signatures[folder]]
+        print('Reusing {} designs from {}, reading {} new or changed folders'.format(len(design_folders) - len(to_read), manifest_path, len(to_read)))
+
+    with timer.stage('read'):
+        results = dict(zip(to_read, read_design_folders(path, to_read, test=args.test, workers=args.workers)))
+    for folder, result in results.items():
+        if result is None and not os.path.exists(os.path.join(os.path.join(path, folder),'design_seq.json')):
+            print('File ', os.path.join(os.path.join(path, folder),'design_seq.json'), ' does not exist')
+    new_sequences = [result[0] for result in results.values() if result is not None]
+
+    with timer.stage('vocab'):
+        if vocab is None:
+            vocab = build_vocab(new_sequences)
+        elif encoding_path == 'NULL':
+            # New words are appended, so existing token records and models stay valid
+            new_words = vocab.extend(*design_words(new_sequences))
+            if new_words:
+                print('Extended the vocabulary with {} new words'.format(len(new_words)))
+        if args.vocab is not None:
+            vocab.save(args.vocab)
+        encoding_dict_keys = vocab.encoding_dict_keys
+        encoding_dict_values = vocab.encoding_dict_values
+
+    ### Build data set
+
+    # [type, value, float]
+    # Encode the new designs as token records and reuse the records of unchanged ones,
+    # gathering the float statistics in the same pass
+    with timer.stage('encode'):
         folder_list = []
-        
+        records = []
+        labels_list = []
+        float_stats = FloatStats()
         for folder in design_folders:
-            if os.path.exists(os.path.join(os.path.join(path, folder),'design_seq.json')):
-            
-                with open(os.path.join(os.path.join(path, folder),'design_seq.json'), "r") as f:
-                    design_sequence_list.append(json.load(f))
-                try:
-                    with open(os.path.join(os.path.join(path, folder),'output.json'), "r") as f:
-
-                        d = json.load(f)
-
-                        mass_list.append(d['Mass'])
-                        interference_list.append(d['Interferences'])
-                        hover_time.append(d['Hover_Time'])
-                        max_speed.append(d['Max_Speed'])
-                        max_distance.append(d['Max_Distance'])
-
-                        if d['Hover_Time']:
-                            airworthy_list.append(1)
-                        else:
-                            airworthy_list.append(0)
-
-                        folder_list.append(folder)
-                except FileNotFoundError:
-                    design_sequence_list.pop()
+            if folder in results:
+                if results[folder] is None:
+                    if manifest is not None:
+                        manifest['folders'].pop(folder, None)
+                    continue
+                design_sequence, labels = results[folder]
+                if manifest is not None:
+                    design_stats = FloatStats()
+                    design_records = encode_design_compact(design_sequence, encoding_dict_keys, encoding_dict_values, design_stats)
+                    manifest['folders'][folder] = {'signature': signatures[folder], 'labels': labels,
+                                                   'records': design_records, 'float_stats': design_stats.state_dict()}
+                    float_stats.merge(design_stats)
+                else:
+                    design_records = encode_design_compact(design_sequence, encoding_dict_keys, encoding_dict_values, float_stats)
             else:
-                print('File ', os.path.join(os.path.join(path, folder),'design_seq.json'), ' does not exist')
-    else:
-        design_sequence_list = []
-        folder_list = []
+                entry = manifest['folders'][folder]
+                design_records, labels = entry['records'], entry['labels']
+                float_stats.merge(FloatStats.from_state_dict(entry['float_stats']))
+            folder_list.append(folder)
+            records.append(design_records)
+            labels_list.append(labels)
+        data_set = compact_data_set(records, encoding_dict_keys, encoding_dict_values, float_stats)
+    print('Working with {} designs'.format(len(folder_list)))
+    n_tokens = data_set['offsets'][-1].item()
 
-        for folder in design_folders:
-            with open(os.path.join(os.path.join(path, folder),'design_seq.json'), "r") as f:
-                design_sequence_list.append(json.load(f))
-                folder_list.append(folder)
+    # Build data one hot from the token records: one indexed gather per design
+    norm_dict = data_set['norm_dict']
+    if args.format == 'dense':
+        with timer.stage('tensors'):
+            compact = CompactData(data_set)
+            data_set = {'X': compact.dense(normalize=False), 'X_norm': compact.dense(normalize=True)}
 
-    print('Working with {} designs'.format(len(folder_list)))
-    lengths = []
-    for design in design_sequence_list:
-        lengths.append(len(design)) 
-    
-    full_keys = [list(item.keys())[0] for design in design_sequence_list for item in design[design_seq_start:]]
-    # filter out black list for generator keys:
-    full_keys = [full_keys[i] for i in range(len(full_keys)) if full_keys[i] not in blacklist_keys]
-    
-    
-    if encoding_path == 'NULL':
-        if USE_DICT:
-            # Use all components in dictionary:
-            full_values = []
-            compTypes = ['Motor', 'Battery', 'Propeller']
-            for compType in compTypes:
-                full_values.extend(list([key for key in list(corpus_dic[compType].keys())]))    
-        #     Extend to those used in the data set
-            # Just use those in the data set:
-            full_values_from_data = [list(item.values())[0] for design in design_sequence_list for item in design[design_seq_start:]]
-            full_values = full_values + full_values_from_data
+    if not args.test:
+        data_set.update({'y': [labels['mass'] for labels in labels_list],
+                         'airworthy': [labels['airworthy'] for labels in labels_list],
+                         'hover_time': [labels['hover_time'] for labels in labels_list],
+                         'max_speed': [labels['max_speed'] for labels in labels_list],
+                         'max_distance': [labels['max_distance'] for labels in labels_list],
+                         'interference_list': [labels['interference'] for labels in labels_list]})
+    data_set.update({'encoding_dict_keys': encoding_dict_keys, 'encoding_dict_values': encoding_dict_values, 'vocab_fingerprint': vocab.fingerprint(), 'norm_dict': norm_dict, 'path':path, 'folders': folder_list})
+    with timer.stage('save'):
+        if args.format == 'sharded':
+            save_sharded(data_set, save_path, args.shard_size)
         else:
-            # Just use those in the data set:
-            full_values = [list(item.values())[0] for design in design_sequence_list for item in design[design_seq_start:]]
-        
-        # filter out black list:
-        full_values = [full_values[i] for i in range(len(full_values)) if full_values[i] not in blacklist]
-        # Build dictionaries
-        encoding_dict_keys = encoding(full_keys)
-        encoding_dict_values = encoding(full_values)
-        
-        # Add explicit float token to values:
-        encoding_dict_values['Value'] = len(encoding_dict_values.values())
-        
-    else:
-        dic = torch.load(encoding_path)
-        encoding_dict_keys = dic['encoding_dict_keys']
-        encoding_dict_values = dic['encoding_dict_values']
-            
-    
-    #### Collect all the floats
-    
-    float_list = []
-    
-    for design in design_sequence_list:
-        for i, d in enumerate(design[design_seq_start:]):
-            item = list(d.items())
-            k = item[0][0]
-            v = item[0][1]
-            if isinstance(v, str):
-                pass
-            else:
-                float_list.append(k)  
-    
-    float_names = set(float_list)
-    float_dict = dict(zip(float_names, [ [] for _ in range(len(float_names)) ]))
-    
-    for design in design_sequence_list:
-        for i, d in enumerate(design[design_seq_start:]):
-            item = list(d.items())
-            k = item[0][0]
-            v = item[0][1]
-            if isinstance(v, str):
-                pass
-            else:
-                for name in float_names:
-                    if k == name:
-                        float_dict[name].append(v)
-
-    for name in float_names:
-        float_dict[name] = torch.tensor(float_dict[name]) 
-        
-    for replace_name, blacklist_name in zip(replacement_blacklist_keys, blacklist_keys):
-        if blacklist_name in float_names:
-            blacklist_values = float_dict.pop(blacklist_name)
-            float_dict[replace_name] = torch.cat([float_dict[replace_name], blacklist_values])
-    
-    float_names = list(float_dict.keys())
-    
-    ### Build data set
-    
-    # [type, value, float]
-    # Build data one hot
-    K_length = len(encoding_dict_keys)
-    V_length = len(encoding_dict_values)
-    Motor_length = Motor.shape[-1]
-    Battery_length = Battery.shape[-1]
-    Propeller_length = Propeller.shape[-1]
-
-    comp_attr_length = Motor_length + Battery_length + Propeller_length
-
-    data = []
-    data_norm = []
-    for design in design_sequence_list:
-        tensor = torch.zeros(len(design[design_seq_start:]), len(encoding_dict_keys) + len(encoding_dict_values) + 1 + comp_attr_length)
-        tensor_norm = torch.zeros(len(design[design_seq_start:]), len(encoding_dict_keys) + len(encoding_dict_values) + 1 + comp_attr_length)
-        for i, d in enumerate(design[design_seq_start:]):
-            item = list(d.items())
-            k = item[0][0]
-            v = item[0][1]
-            
-            if k in blacklist_keys:
-                ind = blacklist_keys.index(k)
-                k = replacement_blacklist_keys[ind]
-            
-            if isinstance(v, str):
-                tensor[i, encoding_dict_keys[k]] = 1
-                tensor[i, K_length + encoding_dict_values[v]] = 1
-                tensor[i,-1] = 0
-
-                tensor_norm[i, encoding_dict_keys[k]] = 1
-                tensor_norm[i, K_length + encoding_dict_values[v]] = 1
-                tensor_norm[i,-1] = 0
-                if k == 'motorType':
-                    start = K_length + V_length                     
-                    stop = K_length + V_length + Motor_length
-                    attributes = list(corpus_dic['Motor'][v].values())
-                    tensor[i,start:stop] = torch.tensor(attributes)
-                    tensor_norm[i,start:stop] = (torch.tensor(attributes) - Motor.mean(0))/Motor.std(0)
-                if k == 'batteryType':
-                    start = K_length + V_length + Motor_length
-                    stop = K_length + V_length + Motor_length + Battery_length
-                    attributes = list(corpus_dic['Battery'][v].values())
-                    tensor[i,start:stop] = torch.tensor(attributes)
-                    tensor_norm[i,start:stop] = (torch.tensor(attributes) - Battery.mean(0))/Battery.std(0)
-                if k == 'propType':
-                    start = K_length + V_length + Motor_length + Battery_length
-                    stop = K_length + V_length + Motor_length + Battery_length + Propeller_length
-                    try:
-                        attributes = list(corpus_dic['Propeller'][v].values())
-                    except KeyError:
-                        attributes = list(corpus_dic['Propeller'][v + 'E'].values())
-                    tensor[i,start:stop] = torch.tensor(attributes)
-                    tensor_norm[i,start:stop] = (torch.tensor(attributes) - Propeller.mean(0))/Propeller.std(0)
-            else:
-                tensor[i, encoding_dict_keys[k]] = 1
-                tensor[i, K_length + encoding_dict_values['Value']] = 1
-                tensor_norm[i, encoding_dict_keys[k]] = 1
-                tensor_norm[i, K_length + encoding_dict_values['Value']] = 1
-                
-                tensor[i,-1] = v
-                
-                for name in float_names:
-                    if name == k:
-                        if isinstance(float_dict[name], torch.BoolTensor):
-                            tensor_norm[i,-1] = float(v)
-                        elif float_dict[name].std() == 0:
-                            tensor_norm[i,-1] = v - float_dict[name].mean()
-                        else:
-                            tensor_norm[i,-1] = (v - float_dict[name].mean())/float_dict[name].std()
-
-        data.append(tensor)
-        data_norm.append(tensor_norm)
-    
-    if args.test:
-        data_set = {'X': data, 'X_norm': data_norm,
-                     'encoding_dict_keys': encoding_dict_keys,
-                     'encoding_dict_values': encoding_dict_values,
-                     'norm_dict': float_dict, 'path':path, 'folders': folder_list}
-        torch.save(data_set, save_path)
-        
-    else: 
-        data_set = {'X': data, 'X_norm': data_norm, 'y': mass_list, 'airworthy': airworthy_list, 'hover_time': hover_time, 'max_speed':max_speed, 'max_distance': max_distance, 'interference_list': interference_list, 'encoding_dict_keys': encoding_dict_keys, 'encoding_dict_values': encoding_dict_values, 'norm_dict': float_dict, 'path':path, 'folders': folder_list}
-        torch.save(data_set, save_path)
\ No newline at end of file
+            torch.save(data_set, save_path)
+
+        if manifest is not None:
+            manifest['folders'] = {folder: manifest['folders'][folder] for folder in folder_list}
+            manifest['vocab'] = vocab.state_dict()
+            torch.save(manifest, manifest_path)
+
+    report = timer.report(designs=len(folder_list), tokens=n_tokens,
+                          designs_read=len(new_sequences), workers=args.workers, format=args.format,
+                          json_parser=design_io.parser, json_io=dict(design_io.stats),
+                          input=path, save_path=save_path)
+    timer.print_report(report)
+    print('JSON: {} files, {:.1f} MB, {:.3f}s reading and {:.3f}s parsing ({}), summed over workers'.format(
+        design_io.stats['files'], design_io.stats['bytes'] / 2**20, design_io.stats['read_seconds'], design_io.stats['parse_seconds'], design_io.parser))
+    if args.timing_json is not None:
+        timer.save_report(report, args.timing_json)
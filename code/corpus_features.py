@@ -0,0 +1,89 @@
+import pickle
+from functools import lru_cache
+
+import torch
+
+'''
+Array-backed view of the component corpus (data/corpus_dic).
+
+The corpus is loaded once, and the attributes of every Motor, Battery and
+Propeller are stacked into a single table in the column layout of a token,
+so the raw and normalized attributes of any number of tokens are one gather.
+'''
+
+comp_types = ['Motor', 'Battery', 'Propeller']
+comp_type_keys = {'motorType': 'Motor', 'batteryType': 'Battery', 'propType': 'Propeller'}
+
+
+class CorpusFeatures:
+    """Component attribute tables built from a corpus dictionary.
+
+    Row 0 of attrs and attrs_norm is all zeros and is used by tokens that do
+    not refer to a component. Every component has one row, with its attributes
+    in the columns of its compType block: [Motor | Battery | Propeller].
+    """
+
+    def __init__(self, corpus_dic):
+        self.corpus_dic = corpus_dic
+        self.tables = {}
+        self.mean = {}
+        self.std = {}
+        for compType in comp_types:
+            self.tables[compType] = torch.stack([torch.tensor(list(attributes.values())) for attributes in corpus_dic[compType].values()])
+            self.mean[compType] = self.tables[compType].mean(0)
+            self.std[compType] = self.tables[compType].std(0)
+
+        self.lengths = {compType: self.tables[compType].shape[-1] for compType in comp_types}
+        self.attr_length = sum(self.lengths.values())
+
+        self.rows = {}
+        self.row_names = [None]
+        attrs = [torch.zeros(1, self.attr_length)]
+        attrs_norm = [torch.zeros(1, self.attr_length)]
+        start = 0
+        for compType in comp_types:
+            table = self.tables[compType]
+            stop = start + table.shape[-1]
+            block = torch.zeros(table.shape[0], self.attr_length)
+            block_norm = torch.zeros(table.shape[0], self.attr_length)
+            block[:, start:stop] = table
+            block_norm[:, start:stop] = (table - self.mean[compType])/self.std[compType]
+            attrs.append(block)
+            attrs_norm.append(block_norm)
+            for name in corpus_dic[compType].keys():
+                self.rows[(compType, name)] = len(self.row_names)
+                self.row_names.append((compType, name))
+            start = stop
+        self.attrs = torch.cat(attrs)
+        self.attrs_norm = torch.cat(attrs_norm)
+
+    def __len__(self):
+        return len(self.row_names)
+
+    def names(self, compType):
+        return list(self.corpus_dic[compType].keys())
+
+    def row(self, compType, name):
+        """Row of a component. Some propellers are only in the corpus with an 'E' suffix."""
+        if compType == 'Propeller' and (compType, name) not in self.rows:
+            name = name + 'E'
+        return self.rows[(compType, name)]
+
+    def key_row(self, key, value):
+        """Row of the token key: value, 0 if the token does not refer to a component."""
+        if key in comp_type_keys and isinstance(value, str):
+            return self.row(comp_type_keys[key], value)
+        return 0
+
+    def gather(self, rows, normalize=False):
+        """Attribute rows, shape [len(rows), attr_length]."""
+        if not torch.is_tensor(rows):
+            rows = torch.tensor(rows)
+        return (self.attrs_norm if normalize else self.attrs)[rows.long()]
+
+
+@lru_cache(maxsize=None)
+def load_corpus_features(corpus_path='../data/corpus_dic'):
+    with open(corpus_path, "rb") as f:
+        corpus_dic = pickle.load(f)
+    return CorpusFeatures(corpus_dic)
@@ -0,0 +1,153 @@
+import argparse
+import io
+import json
+import mmap
+import os
+import time
+
+import numpy as np
+
+import design_io
+
+'''
+python design_archive.py --input ../data_full --output ../data_full_archive
+'''
+
+# The files of a design folder, as in the zip files of the dataset
+design_files = ['design_seq.json', 'design_tree.json', 'design_low_level.json', 'output.json',
+                'pointCloud.npy', 'trims.npy', 'cadfile.stl', 'Geom.stp']
+
+ALIGNMENT = 64 # Payloads start on 64 byte boundaries, so npy arrays can be read in place
+
+
+def pack_designs(path, archive_path, designs=None, pack_size=2**30):
+    """Pack the files of many design folders into a few archive files with an index.
+
+    Files are appended to pack_NNNNN.bin until it holds pack_size bytes, then a
+    new pack is started. index.json maps each design to the pack, offset and
+    size of each of its files.
+
+    Args:
+        path: folder containing the design folders.
+        archive_path: folder to write the packs and index to.
+        designs: design folders to pack, default all folders in path.
+        pack_size: approximate number of bytes per pack file.
+    """
+    if designs is None:
+        designs = sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+    os.makedirs(archive_path, exist_ok=True)
+
+    index = {}
+    packs = []
+    f = None
+    for design in designs:
+        folder_path = os.path.join(path, design)
+        if f is None or f.tell() >= pack_size:
+            if f is not None:
+                f.close()
+            packs.append('pack_{:05d}.bin'.format(len(packs)))
+            f = open(os.path.join(archive_path, packs[-1]), 'wb')
+        entry = {}
+        for name in design_files:
+            file_path = os.path.join(folder_path, name)
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, 'rb') as g:
+                payload = g.read()
+            f.write(b'\0' * (-f.tell() % ALIGNMENT))
+            entry[name] = [len(packs) - 1, f.tell(), len(payload)]
+            f.write(payload)
+        index[design] = entry
+    if f is not None:
+        f.close()
+
+    with open(os.path.join(archive_path, 'index.json'), 'w') as g:
+        json.dump({'packs': packs, 'designs': index}, g)
+    return index
+
+
+class DesignArchive:
+    """Random access reader for an archive written by pack_designs.
+
+    Pack files are memory-mapped when first used, so reading any file of any
+    design is a single slice of a mapping. npy files are returned as read-only
+    arrays backed by the mapping, without copying.
+    """
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        with open(os.path.join(archive_path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.packs = index['packs']
+        self.index = index['designs']
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, design):
+        return design in self.index
+
+    def designs(self):
+        return list(self.index.keys())
+
+    def files(self, design):
+        return list(self.index[design].keys())
+
+    def exists(self, design, name):
+        return design in self.index and name in self.index[design]
+
+    def _map(self, pack):
+        if pack not in self.maps:
+            with open(os.path.join(self.archive_path, self.packs[pack]), 'rb') as f:
+                self.maps[pack] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[pack]
+
+    def read_bytes(self, design, name):
+        """Contents of a file of a design, as a memoryview of the archive."""
+        try:
+            pack, offset, size = self.index[design][name]
+        except KeyError:
+            raise FileNotFoundError('{} of {} is not in {}'.format(name, design, self.archive_path))
+        return memoryview(self._map(pack))[offset:offset + size]
+
+    def open(self, design, name):
+        """File-like object with the contents of a file of a design."""
+        return io.BytesIO(self.read_bytes(design, name))
+
+    def load_json(self, design, name):
+        return design_io.loads(bytes(self.read_bytes(design, name)))
+
+    def load_npy(self, design, name):
+        """Array of an npy file of a design, read in place from the archive."""
+        buffer = self.read_bytes(design, name)
+        length_size = 2 if buffer[6] == 1 else 4
+        header_length = int.from_bytes(buffer[8:8 + length_size], 'little')
+        header = io.BytesIO(buffer[:8 + length_size + header_length])
+        version = np.lib.format.read_magic(header)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+        if dtype.hasobject:
+            return np.load(io.BytesIO(buffer), allow_pickle=True)
+        array = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=header.tell())
+        return array.reshape(shape, order='F' if fortran_order else 'C')
+
+    def load_stl(self, design, name='cadfile.stl'):
+        from stl import mesh
+        return mesh.Mesh.from_file(name, fh=self.open(design, name))
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack design folders into an indexed archive.')
+    parser.add_argument('--input', type=str, help='input directory containing the design folders')
+    parser.add_argument('--output', type=str, help='archive directory, e.g. "../data_full_archive"')
+    parser.add_argument('--pack-size-mb', type=int, help='Approximate size of each pack file in MB', default = 1024)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    index = pack_designs(args.input, args.output, pack_size=args.pack_size_mb * 2**20)
+    elapsed = time.time() - start_time
+    print('Packed {} designs in {:.2f}s ({:.1f} designs/sec)'.format(len(index), elapsed, len(index) / elapsed))
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+
+'''
+Shared reader for the JSON files of the design folders.
+
+Uses orjson when it is installed and falls back to the standard library json
+otherwise. All reads of design JSON by the data build, util.py and the
+notebooks go through read_many, so JSON I/O can be sped up or instrumented
+in one place.
+'''
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The JSON files of a design folder
+kinds = {'seq': 'design_seq.json',
+         'tree': 'design_tree.json',
+         'low_level': 'design_low_level.json',
+         'output': 'output.json'}
+
+# Files and bytes read and seconds spent reading and parsing them, see reset_stats()
+stats = {'files': 0, 'bytes': 0, 'read_seconds': 0., 'parse_seconds': 0.}
+
+parser = 'orjson' if orjson is not None else 'json'
+
+
+def set_parser(name):
+    """Select the JSON parser, 'orjson' or 'json'."""
+    global parser
+    if name == 'orjson' and orjson is None:
+        raise ImportError('orjson is not installed')
+    assert name in ['orjson', 'json']
+    parser = name
+
+def reset_stats():
+    stats.update({'files': 0, 'bytes': 0, 'read_seconds': 0., 'parse_seconds': 0.})
+
+def add_stats(other):
+    """Add the stats of e.g. a worker process to the stats of this process."""
+    for name, value in other.items():
+        stats[name] += value
+
+def loads(content):
+    if parser == 'orjson':
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass # e.g. NaN, which orjson does not accept
+    return json.loads(content)
+
+def read_json(file_path):
+    start = time.perf_counter()
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    read = time.perf_counter()
+    d = loads(content)
+    stats['files'] += 1
+    stats['bytes'] += len(content)
+    stats['read_seconds'] += read - start
+    stats['parse_seconds'] += time.perf_counter() - read
+    return d
+
+def read_many(folders, kind, path=None):
+    """Read the JSON file of one kind from many design folders.
+
+    Args:
+        folders: design folders, relative to path if it is given.
+        kind: 'seq', 'tree', 'low_level' or 'output', or a file name.
+        path: dataset folder, or a design_archive.DesignArchive to read from.
+
+    Returns:
+        A list with the parsed file of each folder, None where it does not exist.
+    """
+    name = kinds.get(kind, kind)
+    if path is not None and not isinstance(path, str):
+        return [_read_archive(path, folder, name) for folder in folders]
+    designs = []
+    for folder in folders:
+        folder_path = folder if path is None else os.path.join(path, folder)
+        try:
+            designs.append(read_json(os.path.join(folder_path, name)))
+        except (FileNotFoundError, NotADirectoryError):
+            designs.append(None)
+    return designs
+
+def read_one(folder, kind, path=None):
+    return read_many([folder], kind, path)[0]
+
+def _read_archive(archive, design, name):
+    if not archive.exists(design, name):
+        return None
+    start = time.perf_counter()
+    content = bytes(archive.read_bytes(design, name))
+    read = time.perf_counter()
+    d = loads(content)
+    stats['files'] += 1
+    stats['bytes'] += len(content)
+    stats['read_seconds'] += read - start
+    stats['parse_seconds'] += time.perf_counter() - read
+    return d
@@ -0,0 +1,210 @@
+import argparse
+import json
+import time
+
+import torch
+from torch import nn
+
+import ssm
+from predict import Predictor
+
+'''
+python export.py --config ../models/transformer_airworthy_model_config --weights airworthy_weights.pt --output ../models/transformer_airworthy --check --data ../data/transformer_data
+'''
+
+
+class ExportModel(nn.Module):
+    """TransformerModel or LSTM with tensor inputs only, for tracing and ONNX.
+
+    The inputs are those of the model, x (dense rows) or key_ids, value_ids,
+    floats and comp_rows (TokenEmbedding), followed by the key padding mask,
+    True at padded positions. The LSTM gets the lengths of the designs from
+    the mask.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.lstm = isinstance(model, ssm.LSTM)
+        self.eval()
+
+    def forward(self, *inputs):
+        mask = inputs[-1]
+        x = inputs[0] if len(inputs) == 2 else inputs[:-1]
+        if self.lstm:
+            return self.model(x, (~mask).sum(1))
+        return self.model(x, mask)
+
+def input_names(model):
+    input_layer = model.embedding if isinstance(model, ssm.LSTM) else model.encoder
+    if isinstance(input_layer, ssm.TokenEmbedding):
+        return ['key_ids', 'value_ids', 'floats', 'comp_rows', 'mask']
+    return ['x', 'mask']
+
+def batch_inputs(x, mask):
+    """Inputs of an ExportModel for a batch (x, mask) of a data loader or CompactCollate."""
+    return (tuple(x) if isinstance(x, tuple) else (x,)) + (mask,)
+
+def example_inputs(model, batch_size=2, seq_len=8):
+    """Inputs to trace a model with. Designs of different lengths, so the padding is part of the trace."""
+    lengths = torch.arange(seq_len, seq_len - batch_size, -1).clamp(min=1)
+    mask = ssm.padding_mask(lengths, seq_len)
+    if input_names(model)[0] == 'x':
+        return torch.zeros(batch_size, seq_len, model_input_size(model)), mask
+    # Separate tensors, the exporter would merge inputs given the same tensor
+    key_ids, value_ids, comp_rows = [torch.zeros(batch_size, seq_len, dtype=torch.long) for _ in range(3)]
+    return key_ids, value_ids, torch.zeros(batch_size, seq_len), comp_rows, mask
+
+def model_input_size(model):
+    return model.embedding.in_features if isinstance(model, ssm.LSTM) else model.encoder.in_features
+
+def export_torchscript(model, inputs, path):
+    """Trace model with the example inputs and save it, frozen, to path.
+
+    The trace keeps the batch and sequence dimensions dynamic: the model
+    only takes sizes from its inputs.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(ExportModel(model), inputs, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return traced
+
+def export_onnx(model, inputs, path, opset=18):
+    """Export model to an ONNX file with dynamic batch and sequence axes. Needs the onnx and onnxscript packages.
+
+    Uses the torch.export based exporter: the TorchScript based one keeps the
+    sequence length of the example inputs in the attention layers.
+    """
+    if isinstance(model, ssm.LSTM) and model.packed:
+        raise ValueError('ONNX has no packed sequences, export the LSTM with packed = False')
+    batch, seq_len = torch.export.Dim('batch'), torch.export.Dim('seq_len')
+    dynamic_shapes = tuple({0: batch, 1: seq_len} for _ in inputs)
+    with torch.no_grad():
+        torch.onnx.export(ExportModel(model), inputs, path, input_names=input_names(model), output_names=['output'],
+                          dynamic_shapes=(dynamic_shapes,), opset_version=opset, dynamo=True, verbose=False)
+
+def onnx_runner(path, threads=None):
+    """Function running an ONNX file on torch tensors with onnxruntime."""
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    if threads is not None:
+        options.intra_op_num_threads = threads
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    names = [i.name for i in session.get_inputs()]
+
+    def run(*inputs):
+        return torch.from_numpy(session.run(None, {name: t.numpy() for name, t in zip(names, inputs)})[0])
+    return run
+
+def max_difference(reference, runner, batches):
+    """Largest absolute difference between the outputs of the eager model and of runner over the batches."""
+    difference = 0.
+    for inputs in batches:
+        with torch.inference_mode():
+            expected = reference(*inputs)
+            difference = max(difference, (runner(*inputs) - expected).abs().max().item())
+    return difference
+
+def repeat_batch(batches, batch_size):
+    """A batch of batch_size designs, cycling through the designs of batches."""
+    rows = [tuple(t[i] for t in inputs) for inputs in batches for i in range(len(inputs[-1]))]
+    L = max(len(row[-1]) for row in rows)
+    rows = [rows[i % len(rows)] for i in range(batch_size)]
+    padded = []
+    for field in zip(*rows):
+        t = field[0].new_zeros((batch_size, L) + field[0].shape[1:])
+        if t.dtype == torch.bool:
+            t.fill_(True)
+        for i, f in enumerate(field):
+            t[i, :len(f)] = f
+        padded.append(t)
+    return tuple(padded)
+
+def latency(runner, inputs, repeats=10):
+    """Median wall time in seconds of runner on inputs, after a warm up run."""
+    times = []
+    with torch.inference_mode():
+        runner(*inputs)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            runner(*inputs)
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a trained model to TorchScript and ONNX, and compare them with the eager model.')
+    parser.add_argument('--config', type=str, help='model config, e.g. "../models/transformer_airworthy_model_config"')
+    parser.add_argument('--encoding', type=str, help='model encoding dictionary or compact data set the model was trained with', default = '../models/transformer_data_model_encoding')
+    parser.add_argument('--weights', type=str, help='model weights (state_dict), if they are not in the model config', default = None)
+    parser.add_argument('--output', type=str, help='prefix of the exported files: <output>.pt (TorchScript), <output>.onnx and <output>.json (inputs, spec and scales)')
+    parser.add_argument('--format', type=str, help='comma separated formats to export: torchscript, onnx', default = 'torchscript,onnx')
+    parser.add_argument('--opset', type=int, help='ONNX opset version', default = 18)
+    parser.add_argument('--check', help="Compare the exported models with the eager model on --data and time them", action="store_true")
+    parser.add_argument('--data', type=str, help='data set of the check, a compact or sharded one for a model with a token embedding', default = '../data/transformer_data')
+    parser.add_argument('--tolerance', type=float, help='Largest absolute difference of the outputs the check accepts', default = 1e-4)
+    parser.add_argument('--batch-sizes', type=str, help='comma separated batch sizes of the timing', default = '1,16,64,256')
+    parser.add_argument('--threads', type=int, help='Number of torch and onnxruntime threads, default: torch default', default = None)
+    parser.add_argument('--timing-json', type=str, help='Also write the check report to this JSON file', default = None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    formats = args.format.split(',')
+    predictor = Predictor.load(args.config, args.encoding, args.weights)
+    model = predictor.model
+    names = input_names(model)
+    inputs = example_inputs(model)
+
+    exported = {}
+    if 'torchscript' in formats:
+        export_torchscript(model, inputs, args.output + '.pt')
+        exported['torchscript'] = torch.jit.load(args.output + '.pt')
+        print('Saved', args.output + '.pt')
+    if 'onnx' in formats:
+        export_onnx(model, inputs, args.output + '.onnx', args.opset)
+        print('Saved', args.output + '.onnx')
+        if args.check:
+            exported['onnx'] = onnx_runner(args.output + '.onnx', args.threads)
+    scales = {}
+    for name in ['scale_1', 'scale_2']:
+        scale = getattr(predictor, name)
+        if isinstance(scale, dict):
+            scales[name] = {spec: None if s is None else float(s) for spec, s in scale.items()}
+        else:
+            scales[name] = None if scale is None else float(scale)
+    with open(args.output + '.json', 'w') as f:
+        json.dump(dict(scales, inputs=names, spec=predictor.spec, seq_len=predictor.collate.seq_len), f, indent=1)
+
+    if args.check:
+        dataloader, _, _ = ssm.prepare_sequence_data(args.data, predictor.spec, batch_size_val=64, frac_train=0.,
+                                                     lazy=names[0] != 'x', batch_eval=True, num_workers=0)
+        if names[0] != 'x':
+            dataloader.collate_fn.output = 'ids'
+        batches = [batch_inputs(x, mask) for x, _, mask, _ in dataloader]
+        eager = ExportModel(model)
+
+        failed = False
+        report = {'parity': {}, 'latency': {}, 'threads': torch.get_num_threads()}
+        for name, runner in exported.items():
+            difference = max_difference(eager, runner, batches)
+            report['parity'][name] = difference
+            failed = failed or difference > args.tolerance
+            print('{:<12s} max abs difference to eager {:.3g} {}'.format(
+                name, difference, 'ok' if difference <= args.tolerance else 'FAILED'))
+
+        runners = dict(eager=eager, **exported)
+        print('{:>6s} {:<12s} {:>12s} {:>14s}'.format('batch', 'format', 'latency (ms)', 'designs/sec'))
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            batch = repeat_batch(batches, batch_size)
+            for name, runner in runners.items():
+                seconds = latency(runner, batch)
+                report['latency'].setdefault(name, {})[batch_size] = seconds
+                print('{:>6d} {:<12s} {:>12.2f} {:>14.1f}'.format(batch_size, name, 1000 * seconds, batch_size / seconds))
+        if args.timing_json is not None:
+            with open(args.timing_json, 'w') as f:
+                json.dump(report, f, indent=4)
+        if failed:
+            raise SystemExit('Exported models differ from the eager model')
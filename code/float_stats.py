@@ -0,0 +1,104 @@
+import math
+
+import torch
+
+'''
+Streaming statistics of the float tokens of design sequences, keyed by the
+token key (e.g. "armLength"). Used to normalize floats in the data set.
+'''
+
+
+class FloatStats:
+    """Count, mean and variance (Welford) and bool detection per float key.
+
+    Values are added one at a time with update(), and statistics gathered by
+    different workers or shards are combined with merge(), so the data set is
+    only walked once.
+    """
+
+    def __init__(self):
+        self.stats = {} # name -> [count, mean, M2, all values are bools]
+
+    def __contains__(self, name):
+        return name in self.stats
+
+    def __len__(self):
+        return len(self.stats)
+
+    def names(self):
+        return list(self.stats.keys())
+
+    def update(self, name, value):
+        if name not in self.stats:
+            self.stats[name] = [0, 0., 0., True]
+        s = self.stats[name]
+        s[0] += 1
+        delta = value - s[1]
+        s[1] += delta / s[0]
+        s[2] += delta * (value - s[1])
+        s[3] = s[3] and isinstance(value, bool)
+
+    def merge(self, other):
+        """Add the statistics of another FloatStats to this one (Chan et al.)."""
+        for name, (count, mean, m2, is_bool) in other.stats.items():
+            if name not in self.stats:
+                self.stats[name] = [count, mean, m2, is_bool]
+                continue
+            s = self.stats[name]
+            total = s[0] + count
+            delta = mean - s[1]
+            s[1] += delta * count / total
+            s[2] += m2 + delta * delta * s[0] * count / total
+            s[0] = total
+            s[3] = s[3] and is_bool
+        return self
+
+    def count(self, name):
+        return self.stats[name][0]
+
+    def mean(self, name):
+        return self.stats[name][1]
+
+    def std(self, name):
+        """Sample standard deviation, as torch.std. Zero for a single value."""
+        count, _, m2, _ = self.stats[name]
+        if count < 2:
+            return 0.
+        return math.sqrt(max(m2, 0.) / (count - 1))
+
+    def is_bool(self, name):
+        return self.stats[name][3]
+
+    def norm_params(self, encoding_dict_keys):
+        """Per key id shift and scale such that a normalized float is (v - shift)/scale.
+
+        Bool keys are not normalized, and keys with constant values are only shifted.
+        """
+        float_shift = torch.zeros(len(encoding_dict_keys))
+        float_scale = torch.ones(len(encoding_dict_keys))
+        for name in self.stats:
+            if self.is_bool(name) or name not in encoding_dict_keys:
+                continue
+            float_shift[encoding_dict_keys[name]] = self.mean(name)
+            if self.std(name) != 0:
+                float_scale[encoding_dict_keys[name]] = self.std(name)
+        return float_shift, float_scale
+
+    def state_dict(self):
+        return {name: {'count': count, 'mean': mean, 'm2': m2, 'bool': is_bool}
+                for name, (count, mean, m2, is_bool) in self.stats.items()}
+
+    @classmethod
+    def from_state_dict(cls, norm_dict):
+        """Load statistics saved by state_dict(), or the 'norm_dict' of older data
+        sets, which holds a tensor of all the values of each key."""
+        float_stats = cls()
+        for name, s in norm_dict.items():
+            if torch.is_tensor(s):
+                values = s.double()
+                m2 = ((values - values.mean())**2).sum().item() if len(values) else 0.
+                mean = values.mean().item() if len(values) else 0.
+                float_stats.stats[name] = [len(values), mean, m2, s.dtype == torch.bool]
+            else:
+                float_stats.stats[name] = [s['count'], s['mean'], s['m2'], s['bool']]
+        return float_stats
@@ -0,0 +1,340 @@
+import argparse
+import copy
+import json
+import os
+import time
+
+import torch
+from torch import nn
+
+import design_io
+import ssm
+from build_transformer_data import corpus, encode_design_compact, read_design_folders
+from design_archive import DesignArchive
+from float_stats import FloatStats
+from prediction_cache import PredictionCache, design_key, model_version
+from vocab import Vocabulary
+
+'''
+python train.py --data ../data/transformer_data --spec airworthy --save-path airworthy
+python predict.py --config airworthy_model_config --input ../data --output predictions.jsonl --threads 8
+'''
+
+
+def model_encoding(dic):
+    """Tables to encode and expand designs for a model: the vocabulary, float
+    normalization and component attributes of the data set it was trained on.
+
+    dic is a compact data set, or the dense 'model encoding' dictionary of
+    build_transformer_data.py, whose norm_dict holds the float statistics.
+    """
+    if 'float_shift' in dic:
+        return {name: dic[name] for name in ['encoding_dict_keys', 'encoding_dict_values', 'comp_attrs',
+                                             'comp_attrs_norm', 'float_shift', 'float_scale']}
+    vocab = Vocabulary.from_data(dic)
+    float_shift, float_scale = FloatStats.from_state_dict(dic['norm_dict']).norm_params(vocab.encoding_dict_keys)
+    return {'encoding_dict_keys': vocab.encoding_dict_keys, 'encoding_dict_values': vocab.encoding_dict_values,
+            'comp_attrs': corpus.attrs, 'comp_attrs_norm': corpus.attrs_norm,
+            'float_shift': float_shift, 'float_scale': float_scale}
+
+def build_model(config):
+    """Model of a model config, as saved by ModelBenchmark.ipynb. A config with
+    a list of 'specs' is a multi-task model."""
+    lstm = config.get('mode', 'transformer') == 'lstm'
+    packed = config.get('packed', False)
+    readout = config.get('readout', 'padded')
+    if 'specs' in config:
+        if lstm:
+            return ssm.MultiTaskLSTM(config['D'], config['emsize'], config['d_hid'], config['specs'], config.get('d_head'),
+                                     packed=packed)
+        return ssm.MultiTaskTransformerModel(config['emsize'], config['nhead'], config['d_hid'], config['nlayers'],
+                                             config['dropout'], config['D'], config['specs'], config.get('d_head'),
+                                             readout=readout)
+    if lstm:
+        return ssm.LSTM(config['D'], config['emsize'], config['d_hid'], packed=packed)
+    return ssm.TransformerModel(config['emsize'], config['nhead'], config['d_hid'], config['nlayers'],
+                                config['dropout'], config['D'], config['D_out'], readout=readout)
+
+def quantize_dynamic(model):
+    """Copy of a model for CPU inference with int8 weights in its Linear and LSTM layers.
+
+    Activations are quantized per batch when the model runs (dynamic
+    quantization). The attention projections of the transformer layers stay
+    in float.
+    """
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).cpu().eval(), {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+
+def unscale(output, spec, scale_1=None, scale_2=None):
+    """Model output of a spec in the units of the target, undoing the normalization of ssm.sequence_targets."""
+    if spec == 'airworthy' or spec == 'interference':
+        output = torch.sigmoid(output)
+    if spec == 'mass' or spec == 'hover':
+        output = output * scale_2 + scale_1
+    if spec == 'dist':
+        output = torch.selu(output) * (scale_2 + scale_1) - scale_1
+    return output
+
+
+class Predictor:
+    """Scores design sequences with a trained model.
+
+    Designs are encoded with the vocabulary and float normalization of the
+    model, batched and run under torch.inference_mode. Predictions are in the
+    units of the target: probabilities for 'airworthy' and 'interference',
+    unscaled values otherwise. For a multi-task model, spec is the list of its
+    specs, scale_1 and scale_2 are dictionaries and a prediction holds one
+    value per spec.
+
+    With a PredictionCache in cache, designs already scored are not run
+    through the model again, and repeats of a design in a batch are scored once.
+    """
+
+    def __init__(self, model, encoding, spec, scale_1=None, scale_2=None, batch_size=256, seq_len=None, version=None,
+                 cache=None):
+        """
+        Args:
+            model: trained TransformerModel or LSTM.
+            encoding: output of model_encoding().
+            spec: target (or list of targets) of the model, as for ssm.prepare_sequence_data.
+            scale_1, scale_2: scales the targets were normalized with.
+            batch_size: number of designs per batch.
+            seq_len: pad batches to at least this many tokens. A
+                TransformerModel with readout 'padded' reads its output at the
+                last padded position, so this should be the padded length the
+                model was trained with.
+            version: model version of the predictions in the cache, default:
+                prediction_cache.model_version of the model.
+            cache: prediction_cache.PredictionCache of this model version.
+        """
+        self.model = model.eval()
+        self.encoding = encoding
+        self.spec = spec
+        self.scale_1 = scale_1
+        self.scale_2 = scale_2
+        self.batch_size = batch_size
+        self.lstm = isinstance(model, ssm.LSTM)
+        input_layer = model.embedding if self.lstm else model.encoder
+        output = 'ids' if isinstance(input_layer, ssm.TokenEmbedding) else 'dense'
+        self.collate = ssm.CompactCollate(encoding, output=output, seq_len=seq_len)
+        # A quantized LSTM has no float parameters, and runs on the CPU
+        self.device = next(model.parameters(), torch.empty(0)).device
+        self.version = version if version is not None else model_version(model, encoding, spec, seq_len)
+        self.cache = cache
+
+    @classmethod
+    def load(cls, config_path, encoding_path, weights_path=None, batch_size=256, seq_len=None, device='cpu', quantize=False):
+        """Load a model config, with its weights in 'state_dict' or in weights_path,
+        and the model encoding dictionary (or compact data set) it was trained with.
+
+        Unless the config has readout 'last', seq_len defaults to the 'seq_len'
+        of the config, or else to the longest design of the model encoding
+        dictionary. quantize = True runs the model with int8 weights
+        (quantize_dynamic), on the CPU only.
+        """
+        config = torch.load(config_path, weights_only=False)
+        dic = torch.load(encoding_path, weights_only=False)
+        encoding = model_encoding(dic)
+        D = len(encoding['encoding_dict_keys']) + len(encoding['encoding_dict_values']) + encoding['comp_attrs'].shape[-1] + 1
+        if D != config['D']:
+            raise ValueError('Model input size {} does not match the encoding ({})'.format(config['D'], D))
+
+        model = build_model(config)
+        if 'state_dict' not in config and weights_path is None:
+            raise ValueError('{} holds no weights (state_dict), give the weights of the model'.format(config_path))
+        state_dict = config['state_dict'] if 'state_dict' in config else torch.load(weights_path, map_location='cpu')
+        if any(name.startswith(('encoder.key_embedding', 'embedding.key_embedding')) for name in state_dict):
+            model = ssm.use_token_embedding(model, encoding)
+        model.load_state_dict(state_dict)
+        if seq_len is None and config.get('readout', 'padded') != 'last':
+            seq_len = config.get('seq_len')
+            if seq_len is None and 'X_norm' in dic:
+                seq_len = max(x.shape[0] for x in dic['X_norm'])
+        spec = config.get('specs', config.get('spec'))
+        # From the float weights, the int8 weights of a quantized LSTM cannot be read back
+        version = model_version(model, encoding, spec, seq_len, quantize)
+        if quantize:
+            if torch.device(device).type != 'cpu':
+                raise ValueError('Quantized models only run on the CPU')
+            model = quantize_dynamic(model)
+        return cls(model.to(device), encoding, spec, config.get('scale_1'), config.get('scale_2'), batch_size, seq_len,
+                   version)
+
+    def encode(self, design):
+        """Token records of a design sequence. Raises KeyError for keys or values the model does not know."""
+        key_ids, value_ids, floats, rows = encode_design_compact(design, self.encoding['encoding_dict_keys'],
+                                                                 self.encoding['encoding_dict_values'])
+        return (torch.tensor(key_ids, dtype=torch.int32), torch.tensor(value_ids, dtype=torch.int32),
+                torch.tensor(floats, dtype=torch.float32), torch.tensor(rows, dtype=torch.int32))
+
+    def predict_records(self, records):
+        """Predictions for a batch of token records."""
+        lengths = torch.tensor([len(r[0]) for r in records])
+        return self.predict_tokens(lengths, *[torch.cat(field) for field in zip(*records)])
+
+    def predict_tokens(self, lengths, key_ids, value_ids, floats, comp_rows):
+        """Predictions for a batch of designs, given their lengths and their
+        concatenated token records (with floats in the units of the design)."""
+        x, mask = self.collate.pad(lengths, key_ids, value_ids, floats, comp_rows)
+        if isinstance(x, tuple):
+            x = tuple(t.to(self.device) for t in x)
+        else:
+            x = x.to(self.device)
+        with torch.inference_mode():
+            if self.lstm:
+                output = self.model(x, lengths.to(self.device))
+            else:
+                output = self.model(x, mask.to(self.device))
+        return self.unscale(output.float().cpu())
+
+    def unscale(self, output):
+        if not isinstance(self.spec, str):
+            return torch.stack([unscale(output[:, t], spec, self.scale_1[spec], self.scale_2[spec])
+                                for t, spec in enumerate(self.spec)], -1)
+        output = unscale(output, self.spec, self.scale_1, self.scale_2)
+        return output.squeeze(-1) if output.shape[-1] == 1 else output
+
+    def predict(self, designs):
+        """Predictions for a list of design sequences, one per design."""
+        if self.cache is None:
+            return torch.cat([self.predict_records([self.encode(d) for d in designs[i:i + self.batch_size]])
+                              for i in range(0, len(designs), self.batch_size)])
+        predictions = [None] * len(designs)
+        for i, prediction, error in self.predict_stream(enumerate(designs)):
+            if error is not None:
+                raise KeyError(error)
+            predictions[i] = prediction if isinstance(self.spec, str) else [prediction[spec] for spec in self.spec]
+        return torch.tensor(predictions)
+
+    def predict_stream(self, named_designs):
+        """Score (name, design_sequence) pairs in batches.
+
+        Yields (name, prediction, error) for every design, with a prediction
+        of None and an error message for designs that cannot be read or
+        encoded. Those are yielded as soon as they are found, as are cached
+        predictions, the others once their batch is scored.
+        """
+        batch = [] # (names, design key, records)
+        pending = {} # design key -> its entry in batch
+        for name, design in named_designs:
+            if design is None:
+                yield name, None, 'no design sequence'
+                continue
+            key = None
+            if self.cache is not None:
+                key = design_key(design)
+                if key in pending:
+                    self.cache.hits['batch'] += 1
+                    pending[key][0].append(name)
+                    continue
+                prediction = self.cache.get(key)
+                if prediction is not None:
+                    yield name, prediction, None
+                    continue
+            try:
+                entry = ([name], key, self.encode(design))
+            except KeyError as e:
+                yield name, None, 'unknown token {}'.format(e)
+                continue
+            batch.append(entry)
+            if key is not None:
+                pending[key] = entry
+            if len(batch) == self.batch_size:
+                yield from self._predict_named(batch)
+                batch = []
+                pending = {}
+        if batch:
+            yield from self._predict_named(batch)
+
+    def _predict_named(self, batch):
+        predictions = self.predict_records([records for _, _, records in batch]).tolist()
+        if not isinstance(self.spec, str):
+            predictions = [dict(zip(self.spec, prediction)) for prediction in predictions]
+        if self.cache is not None:
+            self.cache.put_many((key, prediction) for (_, key, _), prediction in zip(batch, predictions))
+        for (names, _, _), prediction in zip(batch, predictions):
+            for name in names:
+                yield name, prediction, None
+
+
+def iter_designs(input_path, chunk_size=1024, workers=1):
+    """Stream (name, design_sequence) pairs from a JSONL file, a folder of design
+    folders or a design archive.
+
+    Each line of a JSONL file is a design sequence, or an object with a
+    'design_seq' and optionally a 'name'. Designs without a name are named by
+    their line number.
+    """
+    if os.path.isfile(input_path):
+        with open(input_path, 'rb') as f:
+            for n, line in enumerate(f):
+                if not line.strip():
+                    continue
+                d = design_io.loads(line)
+                if isinstance(d, dict):
+                    yield d.get('name', str(n)), d.get('design_seq')
+                else:
+                    yield str(n), d
+    elif os.path.exists(os.path.join(input_path, 'index.json')):
+        archive = DesignArchive(input_path)
+        designs = archive.designs()
+        for i in range(0, len(designs), chunk_size):
+            chunk = designs[i:i + chunk_size]
+            yield from zip(chunk, design_io.read_many(chunk, 'seq', archive))
+    else:
+        folders = sorted(d for d in os.listdir(input_path) if os.path.isdir(os.path.join(input_path, d)))
+        for i in range(0, len(folders), chunk_size):
+            chunk = folders[i:i + chunk_size]
+            results = read_design_folders(input_path, chunk, test=True, workers=workers)
+            yield from zip(chunk, [None if r is None else r[0] for r in results])
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Score design sequences with a trained model.')
+    parser.add_argument('--config', type=str, help='model config, e.g. "../models/transformer_airworthy_model_config"')
+    parser.add_argument('--encoding', type=str, help='model encoding dictionary or compact data set the model was trained with', default = '../models/transformer_data_model_encoding')
+    parser.add_argument('--weights', type=str, help='model weights (state_dict), needed if they are not in the model config, e.g. for the configs in ../models; configs saved by train.py hold them', default = None)
+    parser.add_argument('--input', type=str, help='folder of design folders, design archive, or JSONL file of design sequences')
+    parser.add_argument('--output', type=str, help='JSONL file the predictions are written to as they are computed')
+    parser.add_argument('--batch-size', type=int, help='Number of designs per batch', default = 256)
+    parser.add_argument('--seq-len', type=int, help='Pad batches to at least this many tokens, default: from the model config or encoding (none for readout "last"), 0: per batch', default = None)
+    parser.add_argument('--threads', type=int, help='Number of torch threads, default: torch default', default = None)
+    parser.add_argument('--interop-threads', type=int, help='Number of torch inter-op threads, default: torch default', default = None)
+    parser.add_argument('--workers', type=int, help='Number of processes used to read design folders', default = 1)
+    parser.add_argument('--device', type=str, help='Device to run the model on', default = 'cpu')
+    parser.add_argument('--quantize', help="Run the model with int8 weights in its Linear and LSTM layers (CPU only), see bench_quantize.py for its accuracy", action="store_true")
+    parser.add_argument('--cache', type=str, help='sqlite file of cached predictions, read and extended across runs', default = None)
+    parser.add_argument('--cache-size', type=int, help='Number of predictions cached in memory, default: 100000 with --cache, else no cache', default = None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads is not None:
+        torch.set_num_interop_threads(args.interop_threads)
+
+    predictor = Predictor.load(args.config, args.encoding, args.weights, args.batch_size, args.seq_len, args.device,
+                               args.quantize)
+    if args.cache is not None or args.cache_size:
+        predictor.cache = PredictionCache(predictor.version, args.cache_size or 100000, args.cache)
+
+    start_time = time.time()
+    n_designs = 0
+    n_errors = 0
+    with open(args.output, 'w') as f:
+        for name, prediction, error in predictor.predict_stream(iter_designs(args.input, workers=args.workers)):
+            record = {'design': name, 'prediction': prediction}
+            if error is not None:
+                record['error'] = error
+                n_errors += 1
+            f.write(json.dumps(record) + '\n')
+            n_designs += 1
+            if n_designs % predictor.batch_size == 0:
+                f.flush()
+    elapsed = time.time() - start_time
+    print('Scored {} designs ({} errors) in {:.2f}s ({:.1f} designs/sec)'.format(n_designs, n_errors, elapsed, n_designs / elapsed))
+    if predictor.cache is not None:
+        stats = predictor.cache.stats()
+        print('Cache: {} lookups, hit rate {:.1%} ({} in memory, {} on disk, {} repeated in a batch)'.format(
+            stats['lookups'], stats['hit_rate'], stats['hits']['memory'], stats['hits']['disk'], stats['hits']['batch']))
+        predictor.cache.close()
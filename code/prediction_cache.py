@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+from build_transformer_data import blacklist_keys, design_seq_start, replacement_blacklist_keys
+from vocab import Vocabulary
+
+'''
+Cache of the predictions of a model, keyed by design sequence.
+
+Designs are identified by a hash of their tokens, so the same design made
+by different generator runs, or by mutations that cancel out, is only scored
+once. Predictions are kept in memory (least recently used first out) and
+optionally in an sqlite file that persists across runs. Each prediction is
+stored with the version of the model that made it, so a retrained model or
+a new vocabulary never reads stale predictions.
+'''
+
+CACHE_FORMAT_VERSION = 1
+
+
+def design_key(design):
+    """Canonical hash of a design sequence.
+
+    Only the tokens the model reads count, from design_seq_start on: the
+    generator version and name do not, numbers are compared as floats, so 1
+    and 1.0 are the same value, and blacklisted keys are replaced as by the
+    encoder, so arm1length and arm1Length are the same key.
+    """
+    tokens = []
+    for d in design[design_seq_start:]:
+        (k, v), = d.items()
+        if k in blacklist_keys:
+            k = replacement_blacklist_keys[blacklist_keys.index(k)]
+        tokens.append([k, v if isinstance(v, str) else float(v)])
+    content = json.dumps(tokens, separators=(',', ':'))
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def model_version(model, encoding, spec, seq_len=None, quantized=False):
+    """Hash of everything a prediction depends on besides the design: the
+    architecture and weights of the model, its spec and padded length, and
+    the vocabulary, float normalization and component attributes of its encoding."""
+    h = hashlib.sha1()
+    h.update(json.dumps([CACHE_FORMAT_VERSION, repr(model), spec, seq_len, quantized]).encode())
+    # Attention heads are not part of the repr of a transformer layer
+    h.update(json.dumps([m.num_heads for m in model.modules() if isinstance(m, nn.MultiheadAttention)]).encode())
+    h.update(Vocabulary(encoding['encoding_dict_keys'], encoding['encoding_dict_values']).fingerprint().encode())
+    tensors = list(model.state_dict().items()) + [(name, torch.as_tensor(encoding[name])) for name in
+                                                   ['float_shift', 'float_scale', 'comp_attrs_norm']]
+    for name, value in tensors:
+        if torch.is_tensor(value) and not value.is_quantized:
+            h.update(name.encode())
+            h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+class PredictionCache:
+    """Predictions of one model version by design key, in memory and optionally on disk.
+
+    Args:
+        version: model_version() of the model, e.g. Predictor.version.
+        max_size: number of predictions kept in memory.
+        path: sqlite file the predictions are also saved to and read from.
+            It can hold the predictions of several model versions.
+    """
+
+    def __init__(self, version, max_size=100000, path=None):
+        self.version = version
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.hits = {'memory': 0, 'disk': 0, 'batch': 0}
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS predictions (version TEXT, key TEXT, prediction TEXT, '
+                            'PRIMARY KEY (version, key))')
+
+    def __len__(self):
+        return len(self.memory)
+
+    def get(self, key):
+        """Cached prediction of a design key, or None."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits['memory'] += 1
+            return self.memory[key]
+        if self.db is not None:
+            row = self.db.execute('SELECT prediction FROM predictions WHERE version = ? AND key = ?',
+                                  (self.version, key)).fetchone()
+            if row is not None:
+                self.hits['disk'] += 1
+                prediction = json.loads(row[0])
+                self._remember(key, prediction)
+                return prediction
+        self.misses += 1
+        return None
+
+    def put_many(self, items):
+        """Add (key, prediction) pairs, with predictions as floats or dictionaries of floats."""
+        items = list(items)
+        for key, prediction in items:
+            self._remember(key, prediction)
+        if self.db is not None:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                    [(self.version, key, json.dumps(prediction)) for key, prediction in items])
+
+    def put(self, key, prediction):
+        self.put_many([(key, prediction)])
+
+    def _remember(self, key, prediction):
+        self.memory[key] = prediction
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        """Number of lookups, hits of each layer ('batch': repeats of a design waiting in the same batch) and hit rate."""
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return {'lookups': lookups, 'hits': dict(self.hits), 'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
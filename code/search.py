@@ -0,0 +1,320 @@
+import argparse
+import json
+
+import torch
+
+import ssm
+from build_transformer_data import corpus, design_seq_start
+from corpus_features import comp_type_keys
+from predict import Predictor, iter_designs
+from timing import StageTimer
+from vocab import FLOAT_VALUE
+
+'''
+python search.py --config ../models/transformer_airworthy_model_config,../models/transformer_hover_model_config --weights airworthy_weights.pt,hover_weights.pt --input ../data --population 4096 --generations 20 --min-airworthy 0.5 --output best_designs.jsonl --threads 8
+'''
+
+# Direction of each spec: 1 to maximize it, -1 to minimize it
+default_directions = {'airworthy': 1., 'interference': -1., 'mass': -1., 'dist': 1., 'hover': 1.}
+
+population_fields = ['key_ids', 'value_ids', 'floats', 'comp_rows']
+
+# Kinds of tokens of DesignSpace.kinds
+FIXED, COMPONENT, FLOAT, HUB = 0, 1, 2, 3
+
+
+def hub_groups(schema_path):
+    """Hub node types that can replace each other in a design sequence: those
+    with the same segments and parameters in the schema, so the same tokens follow them."""
+    with open(schema_path, 'r') as f:
+        definitions = json.load(f)['definitions']
+    groups = {}
+    for ref in definitions['ConnectedHub']['anyOf']:
+        hub = ref['$ref'].split('/')[-1]
+        fields = sorted((name, json.dumps(field)) for name, field in definitions[hub]['properties'].items()
+                        if name != 'node_type')
+        groups.setdefault(tuple(fields), []).append(hub)
+    return list(groups.values())
+
+def encode_population(predictor, named_designs):
+    """Population of the designs that the model can encode: a dictionary of
+    their padded token records (raw floats), shape [P, L], their lengths,
+    and the index of the seed design each design derives from.
+
+    Returns the population and the (name, design_sequence) of the seed designs.
+    """
+    seeds = []
+    records = []
+    for name, design in named_designs:
+        if design is None:
+            continue
+        try:
+            records.append(predictor.encode(design))
+        except KeyError:
+            continue
+        seeds.append((name, design))
+    lengths = torch.tensor([len(r[0]) for r in records])
+    mask = ssm.padding_mask(lengths)
+    population = {'lengths': lengths, 'seed': torch.arange(len(records))}
+    for name, field in zip(population_fields, zip(*records)):
+        padded = torch.zeros(mask.shape, dtype=torch.float32 if name == 'floats' else torch.long)
+        padded[~mask] = torch.cat(field).to(padded.dtype)
+        population[name] = padded
+    return population, seeds
+
+def take(population, indices):
+    return {name: t[indices] for name, t in population.items()}
+
+def concat(populations):
+    return {name: torch.cat([p[name] for p in populations]) for name in populations[0]}
+
+def unique(population):
+    """Indices of the distinct designs of a population, the first design of each."""
+    rows = torch.cat([population['key_ids'], population['value_ids'], population['comp_rows'],
+                      population['floats'].view(torch.int32).long()], 1)
+    rows, inverse = torch.unique(rows, dim=0, return_inverse=True)
+    return torch.full((len(rows),), len(inverse), dtype=torch.long).scatter_reduce(
+        0, inverse, torch.arange(len(inverse)), 'amin')
+
+
+class DesignSpace:
+    """Mutations of a population of encoded designs, applied to all designs at once.
+
+    A mutation replaces the value of one token: the component of a
+    motorType, propType or batteryType token by another component of the
+    corpus, a float parameter (armLength, offset, ...) by a value within
+    the range observed in the seed designs, or a hub node type by one with
+    the same segments and parameters. Keys and lengths never change, so a
+    mutated design keeps the structure of its seed design.
+    """
+
+    def __init__(self, encoding, population, schema_path):
+        keys = encoding['encoding_dict_keys']
+        values = encoding['encoding_dict_values']
+        self.float_value = values[FLOAT_VALUE]
+
+        # Components of each component key, as value ids and component rows
+        self.component_key = torch.full((len(keys),), -1, dtype=torch.long)
+        self.components = []
+        for key, compType in comp_type_keys.items():
+            names = []
+            for name in corpus.names(compType):
+                # Designs name propellers that are only in the corpus with an 'E' suffix without it
+                if name.endswith('E') and name[:-1] in values and (compType, name[:-1]) not in corpus.rows:
+                    name = name[:-1]
+                if name in values:
+                    names.append(name)
+            if key in keys and names:
+                self.component_key[keys[key]] = len(self.components)
+                self.components.append((torch.tensor([values[n] for n in names]),
+                                        torch.tensor([corpus.row(compType, n) for n in names])))
+
+        # Range of each float key in the seed designs, keys with a single value or only 0 and 1 are fixed
+        is_float = (population['value_ids'] == self.float_value) & ~ssm.padding_mask(population['lengths'], population['value_ids'].shape[1])
+        key_ids = population['key_ids'][is_float]
+        floats = population['floats'][is_float]
+        self.low = torch.full((len(keys),), float('inf')).scatter_reduce(0, key_ids, floats, 'amin')
+        self.high = torch.full((len(keys),), float('-inf')).scatter_reduce(0, key_ids, floats, 'amax')
+        not_binary = torch.zeros(len(keys)).scatter_reduce(0, key_ids, ((floats != 0) & (floats != 1)).float(), 'amax')
+        self.float_key = (self.high > self.low) & (not_binary > 0)
+
+        # Hub groups of the hubs in the vocabulary, padded to the largest group
+        groups = [[values[hub] for hub in group if hub in values] for group in hub_groups(schema_path)]
+        groups = [group for group in groups if len(group) > 1]
+        self.hub_group = torch.full((len(values),), -1, dtype=torch.long)
+        self.groups = torch.zeros(len(groups), max([len(g) for g in groups], default=0), dtype=torch.long)
+        self.group_sizes = torch.tensor([len(g) for g in groups], dtype=torch.long)
+        for g, group in enumerate(groups):
+            self.hub_group[group] = g
+            self.groups[g, :len(group)] = torch.tensor(group)
+
+    def kinds(self, population):
+        """Kind of each token: FIXED, COMPONENT, FLOAT or HUB, shape [P, L]."""
+        key_ids, value_ids = population['key_ids'], population['value_ids']
+        kinds = torch.full(key_ids.shape, FIXED)
+        kinds[self.component_key[key_ids] >= 0] = COMPONENT
+        kinds[(value_ids == self.float_value) & self.float_key[key_ids]] = FLOAT
+        kinds[self.hub_group[value_ids] >= 0] = HUB
+        kinds[ssm.padding_mask(population['lengths'], key_ids.shape[1])] = FIXED
+        return kinds
+
+    def mutate(self, population, generator, step=0.1):
+        """Copy of the population with one random token of each design mutated.
+
+        Each kind of token of a design is as likely to be mutated, so the few
+        component and hub tokens are not drowned out by the floats. Floats
+        move by a normal step of step times the range of their key, clamped
+        to the range.
+        """
+        population = {name: t.clone() for name, t in population.items()}
+        kinds = self.kinds(population)
+        weights = torch.zeros(kinds.shape)
+        for k in [COMPONENT, FLOAT, HUB]:
+            is_kind = kinds == k
+            weights += is_kind / is_kind.sum(1, keepdim=True).clamp(min=1)
+        designs = torch.nonzero(weights.sum(1) > 0).squeeze(1)
+        position = torch.multinomial(weights[designs], 1, generator=generator).squeeze(1)
+        kind = kinds[designs, position]
+        key_ids = population['key_ids'][designs, position]
+
+        for c, (value_ids, rows) in enumerate(self.components):
+            selected = (kind == COMPONENT) & (self.component_key[key_ids] == c)
+            d, p = designs[selected], position[selected]
+            choice = torch.randint(len(value_ids), (len(d),), generator=generator)
+            population['value_ids'][d, p] = value_ids[choice]
+            population['comp_rows'][d, p] = rows[choice]
+
+        selected = kind == FLOAT
+        d, p, k = designs[selected], position[selected], key_ids[selected]
+        low, high = self.low[k], self.high[k]
+        noise = torch.randn(len(d), generator=generator) * step * (high - low)
+        population['floats'][d, p] = torch.minimum(torch.maximum(population['floats'][d, p] + noise, low), high)
+
+        selected = kind == HUB
+        d, p = designs[selected], position[selected]
+        group = self.hub_group[population['value_ids'][d, p]]
+        member = (torch.rand(len(d), generator=generator) * self.group_sizes[group]).long()
+        population['value_ids'][d, p] = self.groups[group, member]
+        return population
+
+
+def score(predictors, population, batch_size):
+    """Predictions of every spec of the predictors for the designs of a population, {spec: tensor [P]}."""
+    valid = ~ssm.padding_mask(population['lengths'], population['key_ids'].shape[1])
+    scores = {}
+    for predictor in predictors:
+        specs = [predictor.spec] if isinstance(predictor.spec, str) else predictor.spec
+        outputs = []
+        for i in range(0, len(valid), batch_size):
+            batch = slice(i, i + batch_size)
+            fields = [population[name][batch][valid[batch]] for name in population_fields]
+            outputs.append(predictor.predict_tokens(population['lengths'][batch], *fields).view(len(valid[batch]), -1))
+        outputs = torch.cat(outputs)
+        for t, spec in enumerate(specs):
+            scores[spec] = outputs[:, t]
+    return scores
+
+def fitness(scores, objective, direction, min_airworthy=None):
+    """Score to maximize for an objective, -inf for designs predicted not airworthy if min_airworthy is given."""
+    f = direction * scores[objective]
+    if min_airworthy is not None and objective != 'airworthy':
+        f = f.masked_fill(scores['airworthy'] < min_airworthy, float('-inf'))
+    return f
+
+def decode(population, i, seeds, encoding, generation):
+    """Design sequence of design i of a population, with the keys of its seed design."""
+    values = sorted(encoding['encoding_dict_values'], key=encoding['encoding_dict_values'].get)
+    name, seed = seeds[population['seed'][i]]
+    design = [seed[0], {'name': '{}_search_{}'.format(name, generation)}]
+    for j, token in enumerate(seed[design_seq_start:]):
+        (key, original), = token.items()
+        value_id = population['value_ids'][i, j].item()
+        if value_id == encoding['encoding_dict_values'][FLOAT_VALUE]:
+            value = population['floats'][i, j].item()
+            value = bool(value) if isinstance(original, bool) else value
+        else:
+            value = values[value_id]
+        design.append({key: value})
+    return design
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search for designs by mutating design sequences and scoring them with trained models.')
+    parser.add_argument('--config', type=str, help='comma separated model configs, trained with the same encoding')
+    parser.add_argument('--weights', type=str, help='comma separated model weights, one per config, if they are not in the model configs', default = None)
+    parser.add_argument('--encoding', type=str, help='model encoding dictionary or compact data set the models were trained with', default = '../models/transformer_data_model_encoding')
+    parser.add_argument('--input', type=str, help='seed designs: folder of design folders, design archive, or JSONL file of design sequences')
+    parser.add_argument('--output', type=str, help='JSONL file of the best designs of each objective', default = 'best_designs.jsonl')
+    parser.add_argument('--objectives', type=str, help='comma separated specs to optimize, each optionally with ":max" or ":min", default: every spec of the models', default = None)
+    parser.add_argument('--min-airworthy', type=float, help='Only keep designs with at least this predicted probability of being airworthy for the other objectives (needs an airworthy model)', default = None)
+    parser.add_argument('--population', type=int, help='Number of designs scored per generation', default = 4096)
+    parser.add_argument('--generations', type=int, help='Number of generations', default = 20)
+    parser.add_argument('--keep', type=int, help='Number of best designs kept per objective, the parents of the next generation', default = 32)
+    parser.add_argument('--mutations', type=int, help='Number of mutations per design and generation', default = 2)
+    parser.add_argument('--step', type=float, help='Standard deviation of a float mutation, as a fraction of the range of the parameter', default = 0.1)
+    parser.add_argument('--batch-size', type=int, help='Number of designs per model call', default = 1024)
+    parser.add_argument('--schema', type=str, help='schema of the design trees, for the hub types', default = '../schema/uav_schema.json')
+    parser.add_argument('--seed', type=int, help='Random seed', default = 0)
+    parser.add_argument('--threads', type=int, help='Number of torch threads, default: torch default', default = None)
+    parser.add_argument('--timing-json', type=str, help='Also write the timing report to this JSON file', default = None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    generator = torch.Generator().manual_seed(args.seed)
+    configs = args.config.split(',')
+    weights = args.weights.split(',') if args.weights is not None else [None] * len(configs)
+    predictors = [Predictor.load(c, args.encoding, w, args.batch_size) for c, w in zip(configs, weights)]
+    encoding = predictors[0].encoding
+
+    specs = [s for p in predictors for s in ([p.spec] if isinstance(p.spec, str) else p.spec)]
+    if len(set(specs)) < len(specs):
+        raise ValueError('Several models predict the same spec: {}'.format(', '.join(specs)))
+    if args.objectives is None:
+        objectives = {spec: default_directions[spec] for spec in specs}
+    else:
+        objectives = {}
+        for objective in args.objectives.split(','):
+            spec, _, direction = objective.partition(':')
+            objectives[spec] = {'max': 1., 'min': -1., '': default_directions[spec]}[direction]
+    missing = [spec for spec in list(objectives) + (['airworthy'] if args.min_airworthy is not None else []) if spec not in specs]
+    if missing:
+        raise ValueError('No model predicts {}'.format(', '.join(missing)))
+
+    timer = StageTimer()
+    with timer.stage('encode'):
+        population, seeds = encode_population(predictors[0], iter_designs(args.input))
+        space = DesignSpace(encoding, population, args.schema)
+    print('{} seed designs, {} mutable tokens'.format(len(seeds), int((space.kinds(population) != FIXED).sum())))
+
+    archive = None # best designs of each objective, with their scores
+    scored = 0
+    for generation in range(args.generations + 1):
+        if generation > 0:
+            with timer.stage('mutate'):
+                parents = torch.randint(len(archive['population']['seed']), (args.population,), generator=generator)
+                population = take(archive['population'], parents)
+                for _ in range(args.mutations):
+                    population = space.mutate(population, generator, args.step)
+        with timer.stage('score'):
+            population = take(population, unique(population))
+            scores = score(predictors, population, args.batch_size)
+        scored += len(population['seed'])
+
+        with timer.stage('select'):
+            if archive is not None:
+                population = concat([archive['population'], population])
+                scores = {spec: torch.cat([archive['scores'][spec], scores[spec]]) for spec in scores}
+            first = unique(population)
+            population = take(population, first)
+            scores = {spec: s[first] for spec, s in scores.items()}
+            best = {}
+            for objective, direction in objectives.items():
+                f = fitness(scores, objective, direction, args.min_airworthy)
+                best[objective] = f.topk(min(args.keep, len(f))).indices
+            kept = torch.unique(torch.cat(list(best.values())))
+            archive = {'population': take(population, kept), 'scores': {spec: s[kept] for spec, s in scores.items()},
+                       'best': {objective: torch.searchsorted(kept, b) for objective, b in best.items()}}
+
+        elapsed = sum(s['wall'] for name, s in timer.stages.items() if name != 'encode')
+        print('generation {:3d} | {:8d} designs scored | {:9.1f} designs/sec | '.format(generation, scored, scored / elapsed) +
+              ' | '.join('{} {:.4g}'.format(objective, archive['scores'][objective][b[0]].item())
+                         for objective, b in archive['best'].items()))
+
+    with open(args.output, 'w') as f:
+        for objective, b in archive['best'].items():
+            for rank, i in enumerate(b.tolist()):
+                prediction = {spec: s[i].item() for spec, s in archive['scores'].items()}
+                f.write(json.dumps({'objective': objective, 'rank': rank, 'prediction': prediction,
+                                    'seed': seeds[archive['population']['seed'][i]][0],
+                                    'design_seq': decode(archive['population'], i, seeds, encoding, args.generations)}) + '\n')
+
+    report = timer.report(designs=scored, population=args.population, generations=args.generations,
+                          threads=torch.get_num_threads())
+    search_time = sum(s['wall'] for name, s in timer.stages.items() if name != 'encode')
+    report['candidates_per_sec'] = scored / search_time
+    timer.print_report(report)
+    print('{:.1f} candidates scored per second'.format(report['candidates_per_sec']))
+    if args.timing_json is not None:
+        timer.save_report(report, args.timing_json)
@@ -0,0 +1,304 @@
+import argparse
+import json
+import math
+import os
+import re
+import time
+import warnings
+from decimal import Decimal
+
+import design_io
+from design_archive import DesignArchive
+
+'''
+python seq2tree.py --input ../data --check
+python seq2tree.py --input best_designs.jsonl --output best_design_trees.jsonl
+'''
+
+# Generator version and design names UAV2Design accepts
+generator_version = 'UAV2_gen12'
+valid_name_pattern = re.compile('[a-zA-Z0-9_]+')
+
+# Fields of the schema that are not in the sequences of the generator: the
+# ConnectedHub4_1_2_1 case class only has a front, middle and rear segment
+schema_fixes = {'ConnectedHub4_1_2_1': ['mainSegment']}
+
+
+class Grammar:
+    """Converts UAV2 design sequences to design trees and back, without the JVM.
+
+    A Python version of UAV2Design.fromSeq (depth-first sequences, as in
+    design_seq.json) and UAV2Design.fromSeqBF (breadth-first sequences, as
+    in design_seq_bf.json, see BFParser.scala), driven by the node types of
+    schema/uav_schema.json. Node types with alternatives (the hubs, main
+    segments and fuselages) start with a node_type token, the parameters of
+    a node follow in the order of the schema. In breadth-first order a node
+    is followed by its parameters, and its child nodes come after all the
+    nodes of its depth.
+
+    Trees are dictionaries in the key order of the Scala case classes, so
+    to_json(tree) gives the design_tree.json the Scala CLI writes.
+    """
+
+    def __init__(self, schema_path='../schema/uav_schema.json'):
+        with open(schema_path, 'r') as f:
+            schema = json.load(f)
+        self.alternatives = {} # node types of each abstract node type, e.g. MainSegment
+        self.fields = {}       # (key, lower case key, type of the child node or None, JSON type) of each node type
+        for name, definition in schema['definitions'].items():
+            if 'anyOf' in definition:
+                self.alternatives[name] = {ref['$ref'].split('/')[-1] for ref in definition['anyOf']}
+            else:
+                self.fields[name] = self._fields(definition['properties'], schema_fixes.get(name, []))
+        self.root = 'UAV2Design'
+        self.fields[self.root] = self._fields(schema['properties'], [])
+
+    @staticmethod
+    def _fields(properties, dropped):
+        return [(key, key.lower(), p['$ref'].split('/')[-1] if '$ref' in p else None, p.get('type'))
+                for key, p in properties.items() if key != 'node_type' and key not in dropped]
+
+    def parse(self, sequence, bf=False):
+        """Design tree of a sequence, a list of {key: value} tokens as in design_seq.json.
+
+        Keys are compared case insensitively, as by the Scala parser. Integer
+        values of number parameters are read as floats. Raises ValueError if
+        the sequence does not follow the grammar.
+        """
+        tokens = []
+        for token in sequence:
+            (k, v), = token.items()
+            tokens.append((k, v))
+        if bf:
+            tree, pending, pos = self._start(tokens, 0, self.root)
+            while pending:
+                deeper = []
+                for parent, key, node_type in pending:
+                    parent[key], children, pos = self._start(tokens, pos, node_type)
+                    deeper.extend(children)
+                pending = deeper
+        else:
+            tree, pos = self._parse_depth_first(tokens, 0, self.root)
+        if pos < len(tokens):
+            raise ValueError('Extra entries in sequence: {}'.format(tokens[pos:]))
+        if tree['generator_version'] != generator_version:
+            warnings.warn('Parsing a design from generator {} with the grammar of {}'.format(
+                tree['generator_version'], generator_version))
+        if not isinstance(tree['name'], str) or not valid_name_pattern.fullmatch(tree['name']):
+            raise ValueError('Design name must contain letters, numbers and underscores only: {!r}'.format(tree['name']))
+        return tree
+
+    def parse_many(self, sequences, bf=False, strict=True):
+        """Design trees of many sequences. Unless strict, invalid sequences give None instead of a ValueError."""
+        trees = []
+        for sequence in sequences:
+            try:
+                trees.append(self.parse(sequence, bf))
+            except ValueError:
+                if strict:
+                    raise
+                trees.append(None)
+        return trees
+
+    def to_seq(self, tree, bf=False):
+        """Design sequence of a tree, depth-first or breadth-first, the inverse of parse."""
+        sequence = []
+        pending = [(tree, self.root)]
+        while pending:
+            deeper = []
+            for node, node_type in pending:
+                self._emit(node, node_type, sequence, deeper if bf else None)
+            pending = deeper
+        return sequence
+
+    def _node_type(self, tokens, pos, node_type):
+        """Concrete node type of the node at pos and the position of its first parameter."""
+        if node_type not in self.alternatives:
+            return node_type, pos
+        name, pos = _read(tokens, pos, 'node_type', 'node_type', 'string')
+        if name not in self.alternatives[node_type]:
+            raise ValueError('Unexpected node_type for {}: {}'.format(node_type, name))
+        return name, pos
+
+    def _start(self, tokens, pos, node_type):
+        """Read the node type and parameters of a node, with empty child nodes.
+        Returns the node, its (node, key, node type) children and the new position."""
+        concrete, pos = self._node_type(tokens, pos, node_type)
+        node = {'node_type': concrete} if concrete != node_type else {}
+        children = []
+        for key, lower, child, kind in self.fields[concrete]:
+            if child is None:
+                node[key], pos = _read(tokens, pos, key, lower, kind)
+            else:
+                node[key] = None
+                children.append((node, key, child))
+        return node, children, pos
+
+    def _parse_depth_first(self, tokens, pos, node_type):
+        concrete, pos = self._node_type(tokens, pos, node_type)
+        node = {'node_type': concrete} if concrete != node_type else {}
+        for key, lower, child, kind in self.fields[concrete]:
+            if child is None:
+                node[key], pos = _read(tokens, pos, key, lower, kind)
+            else:
+                node[key], pos = self._parse_depth_first(tokens, pos, child)
+        return node, pos
+
+    def _emit(self, node, node_type, sequence, deeper):
+        if node_type in self.alternatives:
+            sequence.append({'node_type': node['node_type']})
+            node_type = node['node_type']
+        for key, _, child, _ in self.fields[node_type]:
+            if child is None:
+                sequence.append({key: node[key]})
+            elif deeper is not None:
+                deeper.append((node[key], child))
+            else:
+                self._emit(node[key], child, sequence, None)
+
+def _read(tokens, pos, key, lower, kind):
+    if pos >= len(tokens):
+        raise ValueError('Expected {}, got the end of the sequence'.format(key))
+    k, v = tokens[pos]
+    if k.lower() != lower:
+        raise ValueError('Expected key {}, got {}'.format(key, k))
+    if kind == 'number' and isinstance(v, int) and not isinstance(v, bool):
+        v = float(v)
+    if kind is not None and not isinstance(v, {'number': float, 'string': str, 'boolean': bool}[kind]):
+        raise ValueError('Expected a {} for {}, got {!r}'.format(kind, key, v))
+    return v, pos + 1
+
+def java_double(x):
+    """x as written by Java's Double.toString: at least one decimal, scientific notation below 1e-3 and from 1e7 on."""
+    if math.isnan(x):
+        return 'NaN'
+    if math.isinf(x):
+        return 'Infinity' if x > 0 else '-Infinity'
+    if x == 0:
+        return '-0.0' if math.copysign(1., x) < 0 else '0.0'
+    if 1e-3 <= abs(x) < 1e7:
+        # Python also writes these without an exponent, with the same shortest digits
+        return repr(x)
+    sign = '-' if x < 0 else ''
+    _, digits, exponent = Decimal(repr(abs(x))).normalize().as_tuple()
+    digits = ''.join(map(str, digits))
+    e = len(digits) + exponent - 1
+    return sign + digits[0] + '.' + (digits[1:] or '0') + 'E' + str(e)
+
+def to_json(tree, indent=0):
+    """A design tree as the pretty printed JSON of the Scala CLI (json4s writePretty)."""
+    items = []
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            value = to_json(value, indent + 1)
+        elif isinstance(value, bool):
+            value = 'true' if value else 'false'
+        elif isinstance(value, float):
+            value = java_double(value)
+        else:
+            value = json.dumps(value, ensure_ascii=False)
+        items.append('  ' * (indent + 1) + json.dumps(key) + ':' + value)
+    return '{\n' + ',\n'.join(items) + '\n' + '  ' * indent + '}'
+
+def iter_sequences(input_path, file_name, chunk_size=1024):
+    """Stream (name, design sequence, design folder path or None) from a design folder, a folder of design
+    folders, a design archive or a JSONL file of sequences (as read by predict.py and written by search.py)."""
+    if os.path.isfile(input_path):
+        with open(input_path, 'rb') as f:
+            for n, line in enumerate(f):
+                if not line.strip():
+                    continue
+                d = design_io.loads(line)
+                if isinstance(d, dict):
+                    yield d.get('name', str(n)), d.get('design_seq'), None
+                else:
+                    yield str(n), d, None
+        return
+    if os.path.exists(os.path.join(input_path, file_name)):
+        yield os.path.basename(os.path.normpath(input_path)), design_io.read_json(os.path.join(input_path, file_name)), input_path
+        return
+    if os.path.exists(os.path.join(input_path, 'index.json')):
+        path = DesignArchive(input_path)
+        folders = path.designs()
+    else:
+        path = input_path
+        folders = sorted(d for d in os.listdir(input_path) if os.path.isdir(os.path.join(input_path, d)))
+    for i in range(0, len(folders), chunk_size):
+        chunk = folders[i:i + chunk_size]
+        for folder, sequence in zip(chunk, design_io.read_many(chunk, file_name, path)):
+            if sequence is not None:
+                yield folder, sequence, (folder, path)
+
+def read_tree_text(location):
+    """Text of the design_tree.json of a design folder of iter_sequences, None if it has none."""
+    if isinstance(location, str):
+        folder, path = location, None
+    else:
+        folder, path = location
+    if isinstance(path, DesignArchive):
+        return bytes(path.read_bytes(folder, 'design_tree.json')).decode() if path.exists(folder, 'design_tree.json') else None
+    file_path = os.path.join(folder if path is None else os.path.join(path, folder), 'design_tree.json')
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, encoding='utf-8') as f:
+        return f.read()
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert UAV2 design sequences to design trees, like prob_gen/scripts/seq2tree-uav2.sh without starting the JVM.')
+    parser.add_argument('--input', type=str, help='design folder, folder of design folders, design archive, or JSONL file of design sequences (e.g. the output of search.py)')
+    parser.add_argument('--output', type=str, help='file name of the tree written in each design folder (e.g. "design_tree_reconstructed.json"), or JSONL file of {"name", "design_tree"} for a JSONL input', default = None)
+    parser.add_argument('--schema', type=str, help='schema of the design trees', default = '../schema/uav_schema.json')
+    parser.add_argument('--bf', help="Parse breadth-first sequences (design_seq_bf.json in design folders)", action="store_true")
+    parser.add_argument('--check', help="Compare the trees with the design_tree.json of each design folder, also after a round trip through a breadth-first sequence", action="store_true")
+    parser.add_argument('--skip-invalid', help="Count and skip sequences that do not follow the grammar instead of stopping", action="store_true")
+    args = parser.parse_args()
+
+    if args.output is None and not args.check:
+        parser.error('nothing to do, give --output or --check')
+    grammar = Grammar(args.schema)
+    jsonl = os.path.isfile(args.input)
+    out = open(args.output, 'w') if jsonl and args.output is not None else None
+
+    counts = {'designs': 0, 'invalid': 0, 'checked': 0, 'mismatches': 0}
+    parse_seconds = 0.
+    for name, sequence, location in iter_sequences(args.input, 'design_seq_bf.json' if args.bf else 'design_seq.json'):
+        counts['designs'] += 1
+        start = time.perf_counter()
+        try:
+            tree = grammar.parse(sequence, args.bf)
+        except (ValueError, AttributeError, TypeError) as e:
+            if not args.skip_invalid:
+                raise ValueError('{}: {}'.format(name, e))
+            counts['invalid'] += 1
+            continue
+        finally:
+            parse_seconds += time.perf_counter() - start
+        text = to_json(tree)
+        if args.check and location is not None:
+            expected = read_tree_text(location)
+            if expected is not None:
+                round_trip = to_json(grammar.parse(grammar.to_seq(tree, bf=True), bf=True))
+                counts['checked'] += 1
+                if text != expected or round_trip != expected:
+                    counts['mismatches'] += 1
+                    print('{}: tree differs from design_tree.json{}'.format(
+                        name, '' if text == expected else ' (after a breadth-first round trip)'))
+        if out is not None:
+            out.write(json.dumps({'name': name, 'design_tree': tree}) + '\n')
+        elif args.output is not None and location is not None:
+            folder, path = (location, None) if isinstance(location, str) else location
+            if isinstance(path, DesignArchive):
+                raise ValueError('Cannot write trees into a design archive, use a JSONL input')
+            with open(os.path.join(folder if path is None else os.path.join(path, folder), args.output), 'w', encoding='utf-8') as f:
+                f.write(text)
+    if out is not None:
+        out.close()
+
+    print('{} sequences, {} invalid, {:.1f} designs/sec'.format(
+        counts['designs'], counts['invalid'], counts['designs'] / max(parse_seconds, 1e-9)))
+    if args.check:
+        print('{} trees checked against design_tree.json, {} differ'.format(counts['checked'], counts['mismatches']))
+        if counts['mismatches']:
+            raise SystemExit('Trees differ from design_tree.json')
@@ -1,6 +1,10 @@
+import hashlib
 import math
+import os
+import json
 from typing import Tuple
 
+import numpy as np
 import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
@@ -9,21 +13,29 @@ from torch.utils.data import dataset
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
+
+# Targets of prepare_sequence_data, see sequence_targets()
+specs = ['airworthy', 'interference', 'mass', 'dist', 'hover']
+classification_specs = ['airworthy', 'interference']
+
+max_mass = 35. # (kg), heavier designs are left out of the 'mass' target
 
 class Data(Dataset):
     """Simple Dataset"""
 
-    def __init__(self, x_train, y_train, mask, transform=None):
+    def __init__(self, x_train, y_train, lengths, transform=None):
         """
         Args:
+            lengths: number of tokens of each design, x_train is padded beyond.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
         """
         
         self.x_train = x_train
         self.y_train = y_train
-        self.mask = mask
+        self.lengths = lengths
         self.transform = transform
 
     def __len__(self):
@@ -33,102 +45,657 @@ class Data(Dataset):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        sample = (self.x_train[idx], self.y_train[idx], self.mask[idx])
+        sample = (self.x_train[idx], self.y_train[idx], self.lengths[idx])
 
         if self.transform:
             sample = self.transform(sample)
 
         return sample
 
-def prepare_sequence_data(data_path, spec, batch_size = 512 ,batch_size_val = 512, frac_train = 0.7, frac_val = 0.1):
-    assert frac_train + frac_val < 1.
-    
-    scale_1 = None # min/mean
-    scale_2 = None #max/std
+class BucketBatchSampler(Sampler):
+    """Batches of designs of similar length.
+
+    Designs are sorted by length (in random order among equal lengths when
+    shuffling) and cut into batches of batch_size designs, or, if max_tokens
+    is given, of as many designs as fit in max_tokens padded tokens. The order
+    of the batches is shuffled every epoch. Use with trim_collate so each
+    batch is only padded to its own longest design.
+    """
+
+    def __init__(self, lengths, batch_size=512, max_tokens=None, shuffle=True, seed=0):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        if max_tokens is not None:
+            assert max_tokens >= self.lengths.max(), 'max_tokens is smaller than the longest design'
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, generator=None):
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=generator)
+        else:
+            order = torch.arange(len(self.lengths))
+        order = order[torch.sort(self.lengths[order], stable=True).indices].tolist()
+
+        batches = []
+        batch = []
+        for i in order:
+            # Sorted by length, so design i is the longest of the batch so far
+            if batch and (len(batch) == self.batch_size if self.max_tokens is None
+                          else (len(batch) + 1) * self.lengths[i] > self.max_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator)]
+        return batches
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        return iter(self.batches(generator))
+
+    def __len__(self):
+        return len(self.batches(torch.Generator().manual_seed(self.seed)))
+
+def padding_mask(lengths, seq_len=None):
+    """Key padding mask, True at the positions beyond the length of each sequence, shape [batch_size, seq_len]."""
+    if seq_len is None:
+        seq_len = int(lengths.max())
+    return torch.arange(seq_len, device=lengths.device) >= lengths[:, None]
+
+def length_collate(batch):
+    """Collate padded designs of Data into (x, y, mask, lengths)."""
+    x, y, lengths = default_collate(batch)
+    return x, y, padding_mask(lengths, x.shape[1]), lengths
+
+def trim_collate(batch):
+    """As length_collate, but cut off the padding beyond the longest design of the batch."""
+    x, y, lengths = default_collate(batch)
+    L = int(lengths.max())
+    return x[:, :L], y, padding_mask(lengths, L), lengths
+
+class CompactData:
+    """Token records of a data set saved with build_transformer_data.py --format compact.
+
+    Each token is stored as a key id, a value id, a float and a component row.
+    Dense (or normalized) one-hot rows are only built when asked for.
+    """
+
+    def __init__(self, dic):
+        assert dic.get('format') == 'compact'
+        self.dic = dic
+        self.offsets = dic['offsets']
+        self.n_keys = len(dic['encoding_dict_keys'])
+        self.n_values = len(dic['encoding_dict_values'])
+        self.float_value_id = dic['encoding_dict_values']['Value']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    @property
+    def D(self):
+        return self.n_keys + self.n_values + self.dic['comp_attrs'].shape[-1] + 1
+
+    def records(self, idx):
+        """Token records (key_ids, value_ids, floats, comp_rows) of design idx."""
+        start, stop = self.offsets[idx].item(), self.offsets[idx + 1].item()
+        return (self.dic['key_ids'][start:stop], self.dic['value_ids'][start:stop],
+                self.dic['floats'][start:stop], self.dic['comp_rows'][start:stop])
+
+    def token_rows(self, idx, normalize=True):
+        """Dense rows of design idx, shape [seq_len, D]."""
+        return expand_token_records(self.dic, *self.records(idx), normalize=normalize)
+
+    def dense(self, normalize=True):
+        """Dense rows of every design, as the 'X' (or 'X_norm') list of a dense data set."""
+        return [self.token_rows(i, normalize) for i in range(len(self))]
+
+def expand_token_records(dic, key_ids, value_ids, floats, comp_rows, normalize=True):
+    """Expand token records to dense rows, using the tables of a compact data set.
+
+    The row layout is [key one-hot, value one-hot, component attributes, float],
+    as written by build_transformer_data.py.
+    """
+    key_ids = key_ids.long()
+    value_ids = value_ids.long()
+    comp_rows = comp_rows.long()
+
+    K = len(dic['encoding_dict_keys'])
+    V = len(dic['encoding_dict_values'])
+    comp_attrs = dic['comp_attrs_norm'] if normalize else dic['comp_attrs']
+    C = comp_attrs.shape[-1]
+    L = len(key_ids)
+    tokens = torch.arange(L)
+
+    X = torch.zeros(L, K + V + C + 1)
+    X[tokens, key_ids] = 1
+    X[tokens, K + value_ids] = 1
+    X[:, K + V:K + V + C] = comp_attrs[comp_rows]
+    X[:, -1] = normalize_floats(dic, key_ids, value_ids, floats) if normalize else floats
+    return X
+
+def normalize_floats(dic, key_ids, value_ids, floats):
+    """Normalize the floats of float tokens ('Value') with the float_shift and float_scale of their key."""
+    key_ids = key_ids.long()
+    is_float = value_ids.long() == dic['encoding_dict_values']['Value']
+    return torch.where(is_float, (floats - dic['float_shift'][key_ids])/dic['float_scale'][key_ids], floats)
+
+def load_compact_data(data_path):
+    return CompactData(torch.load(data_path))
+
+class ShardedData(CompactData):
+    """Data set saved with build_transformer_data.py --format sharded.
+
+    The token records are flat arrays split into shards of a fixed number of
+    designs, with the offsets of each design into its shard. Shards are
+    memory-mapped when first used, so opening the data set only reads
+    meta.json, and processes on one node share the same page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            dic = json.load(f)
+        assert dic.get('format') == 'sharded'
+        for name in ['comp_attrs', 'comp_attrs_norm', 'float_shift', 'float_scale']:
+            dic[name] = torch.from_numpy(np.load(os.path.join(path, name + '.npy')))
+        self.dic = dic
+        self.shard_size = dic['shard_size']
+        self.n_keys = len(dic['encoding_dict_keys'])
+        self.n_values = len(dic['encoding_dict_values'])
+        self.float_value_id = dic['encoding_dict_values']['Value']
+        self.shards = {}
+        self._offsets = None
+
+    def __len__(self):
+        return self.dic['n_designs']
+
+    def shard(self, n):
+        if n not in self.shards:
+            shard_path = os.path.join(self.path, self.dic['shards'][n])
+            self.shards[n] = {name: np.load(os.path.join(shard_path, name + '.npy'), mmap_mode='r')
+                              for name in ['key_ids', 'value_ids', 'floats', 'comp_rows', 'offsets']}
+        return self.shards[n]
+
+    @property
+    def offsets(self):
+        """Offsets of all designs into the concatenated token records."""
+        if self._offsets is None:
+            offsets = [torch.zeros(1, dtype=torch.int64)]
+            for n in range(len(self.dic['shards'])):
+                shard_offsets = torch.from_numpy(np.array(self.shard(n)['offsets'][1:]))
+                offsets.append(shard_offsets + offsets[-1][-1])
+            self._offsets = torch.cat(offsets)
+        return self._offsets
+
+    def __getstate__(self):
+        # Do not pickle the memory maps, e.g. for DataLoader workers, they are reopened when used
+        return dict(self.__dict__, shards={})
+
+    def records(self, idx):
+        shard = self.shard(idx // self.shard_size)
+        i = idx % self.shard_size
+        start, stop = shard['offsets'][i], shard['offsets'][i + 1]
+        return tuple(torch.from_numpy(np.array(shard[name][start:stop]))
+                     for name in ['key_ids', 'value_ids', 'floats', 'comp_rows'])
+
+class CompactSequenceData(Dataset):
+    """Dataset of designs of a compact or sharded data set, kept as token records.
+
+    Items are (records, y) with the records (key_ids, value_ids, floats,
+    comp_rows) of a design. CompactCollate expands them to dense rows per
+    batch, so memory scales with the number of tokens instead of
+    N x max_len x D.
+    """
+
+    def __init__(self, data, indices, y):
+        """
+        Args:
+            data: CompactData or ShardedData.
+            indices: designs of data in this dataset.
+            y: targets, one per index.
+        """
+        self.data = data
+        self.indices = torch.as_tensor(indices)
+        self.y_train = y
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        return self.data.records(self.indices[idx].item()), self.y_train[idx]
+
+class CompactCollate:
+    """Collate token records of CompactSequenceData into a padded batch.
+
+    With output='dense' a batch is (x, y, mask, lengths) as for Data, with x
+    of shape [batch_size, seq_len, D] holding the normalized (or raw) dense
+    rows. With output='ids' x is the tuple (key_ids, value_ids, floats,
+    comp_rows), each of shape [batch_size, seq_len], with normalized floats,
+    for an embedding input layer. mask is True at padded positions and lengths
+    holds the number of tokens of each design. Batches are padded to their
+    longest design, or to at least seq_len tokens if it is given.
+    """
+
+    def __init__(self, dic, normalize=True, output='dense', seq_len=None):
+        assert output in ['dense', 'ids']
+        self.dic = {name: dic[name] for name in ['encoding_dict_keys', 'encoding_dict_values', 'comp_attrs',
+                                                 'comp_attrs_norm', 'float_shift', 'float_scale']}
+        self.normalize = normalize
+        self.output = output
+        self.seq_len = seq_len
+
+    def __call__(self, batch):
+        records, y = zip(*batch)
+        y = default_collate(y)
+        lengths = torch.tensor([len(r[0]) for r in records])
+        x, mask = self.pad(lengths, *[torch.cat(field) for field in zip(*records)])
+        return x, y, mask, lengths
+
+    def pad(self, lengths, key_ids, value_ids, floats, comp_rows):
+        """Padded x and mask of a batch of designs, given their lengths and their concatenated token records."""
+        L = max(lengths.max().item(), self.seq_len or 0)
+        mask = padding_mask(lengths, L)
+        if self.output == 'ids':
+            if self.normalize:
+                floats = normalize_floats(self.dic, key_ids, value_ids, floats)
+            x = []
+            for field in [key_ids.long(), value_ids.long(), floats, comp_rows.long()]:
+                padded = field.new_zeros(len(lengths), L)
+                padded[~mask] = field
+                x.append(padded)
+            return tuple(x), mask
+        rows = expand_token_records(self.dic, key_ids, value_ids, floats, comp_rows, self.normalize)
+        x = rows.new_zeros(len(lengths), L, rows.shape[-1])
+        x[~mask] = rows
+        return x, mask
+
+def load_data(data_path):
+    """Load a data set saved by build_transformer_data.py in any format: a dense or
+    compact dictionary (file) or a sharded data set (directory)."""
+    if os.path.isdir(data_path):
+        return ShardedData(data_path)
     dic = torch.load(data_path)
+    if dic.get('format') == 'compact':
+        return CompactData(dic)
+    return dic
+
+def sequence_targets(dic, spec):
+    """Targets of spec for the designs of a data set.
 
-    seq_len_max = max([d.shape[0] for d in dic['X_norm']])
-    X_norm = [dic['X_norm'][i] for i in range(len(dic['X_norm'])) if dic['X_norm'][i].shape[0] <= seq_len_max]
+    Returns:
+        The indices of the designs with a valid target, their targets and the
+        scales the targets were normalized with (None if not normalized).
+    """
+    scale_1 = None # min/mean
+    scale_2 = None #max/std
     if spec == 'airworthy':
-        Y = torch.tensor([dic['airworthy'][i] for i in range(len(dic['airworthy'])) if dic['X_norm'][i].shape[0] <= seq_len_max])
+        Y = torch.tensor(dic['airworthy'])
+        keep = torch.arange(len(Y))
     if spec == 'interference':
-        Y = torch.tensor([dic['interference_list'][i] > 0 for i in range(len(dic['interference_list'])) if dic['X_norm'][i].shape[0] <= seq_len_max]).int()
+        Y = torch.tensor([value > 0 for value in dic['interference_list']]).int()
+        keep = torch.arange(len(Y))
     if spec == 'mass':
-        X_norm = [dic['X_norm'][i] for i in range(len(dic['X_norm'])) if dic['X_norm'][i].shape[0] <= seq_len_max and dic['y'][i] < max_mass]
-        Y = torch.tensor([dic['y'][i] for i in range(len(dic['airworthy'])) if dic['X_norm'][i].shape[0] <= seq_len_max and dic['y'][i] <max_mass])
+        keep = torch.tensor([i for i in range(len(dic['airworthy'])) if dic['y'][i] < max_mass], dtype=torch.long)
+        Y = torch.tensor([dic['y'][i] for i in keep.tolist()])
         valid_ind = torch.logical_not(torch.isnan(Y)) # Remove Nan masses
-        X_norm = [X_norm[i] for i in range(len(X_norm)) if valid_ind[i].item()]
+        keep = keep[valid_ind]
         scale_1 = Y[valid_ind].mean(0)
         scale_2 = Y[valid_ind].std(0)
         Y = (Y[valid_ind] - scale_1)/scale_2
     if spec == 'dist':
         dist = [0. if value is None else value for value in dic['max_distance']]
-        Y = torch.tensor([dist[i] for i in range(len(dic['max_distance'])) if dic['X_norm'][i].shape[0] <= seq_len_max])
+        Y = torch.tensor(dist)
         valid_ind = torch.logical_not(torch.isnan(Y)) # Remove Nan masses
-        X_norm = [X_norm[i] for i in range(len(X_norm)) if valid_ind[i].item()]
+        keep = torch.arange(len(Y))[valid_ind]
         scale_1 = Y[valid_ind].min()
         scale_2 = Y[valid_ind].max()
         Y = (Y[valid_ind] + Y[valid_ind].min())/(scale_2 - scale_1)
     if spec == 'hover':
         dist = [0 if value is None else value for value in dic['hover_time']]
-        Y = torch.tensor([dist[i] for i in range(len(dic['hover_time'])) if dic['X_norm'][i].shape[0] <= seq_len_max])
+        Y = torch.tensor(dist)
         valid_ind = torch.logical_not(torch.isnan(Y)) # Remove Nan masses
-        X_norm = [X_norm[i] for i in range(len(X_norm)) if valid_ind[i].item()]
+        keep = torch.arange(len(Y))[valid_ind]
         scale_1 = Y[valid_ind].mean(0)
         scale_2 = Y[valid_ind].std(0)
-        Y = (Y[valid_ind] - scale_1)/scale_2 
-
-    X = torch.nn.utils.rnn.pad_sequence(X_norm).transpose(0,1) # padding sequences
-
-    src_mask = torch.zeros(X.shape[0],seq_len_max).bool()
-    for n, d in enumerate(X):
-        src_mask[n] = (d.sum(-1) == 0)
-
-    D = X.shape[-1]
-    N = X.shape[0]
-    SL = X.shape[-2] # sequence length
+        Y = (Y[valid_ind] - scale_1)/scale_2
+    return keep, Y, scale_1, scale_2
+
+def multi_task_targets(dic, task_specs=specs):
+    """Targets of several specs for every design of a data set.
+
+    Returns:
+        Y: targets, shape [N, len(task_specs)], NaN where a design has no valid target of a spec.
+        valid: validity mask, shape [N, len(task_specs)].
+        scale_1, scale_2: dictionaries of the scales of each spec, as returned by sequence_targets.
+    """
+    N = len(dic['airworthy'])
+    Y = torch.full((N, len(task_specs)), float('nan'))
+    scale_1 = {}
+    scale_2 = {}
+    for t, spec in enumerate(task_specs):
+        keep, y, scale_1[spec], scale_2[spec] = sequence_targets(dic, spec)
+        Y[keep, t] = y.float()
+    return Y, ~torch.isnan(Y), scale_1, scale_2
+
+def multi_task_loss(output, targets, task_specs=specs):
+    """Mean over the specs of the loss of each spec, over the designs with a valid target.
+
+    Binary cross entropy on the logits of classification specs, mean squared
+    error otherwise (of the selu of the output for 'dist', as in ModelBenchmark.ipynb).
+
+    Returns:
+        The total loss and a dictionary of the loss of each spec.
+    """
+    losses = {}
+    for t, spec in enumerate(task_specs):
+        valid = ~torch.isnan(targets[:, t])
+        if not valid.any():
+            continue
+        o = output[valid, t]
+        y = targets[valid, t]
+        if spec in classification_specs:
+            losses[spec] = F.binary_cross_entropy_with_logits(o, y)
+        elif spec == 'dist':
+            losses[spec] = F.mse_loss(torch.selu(o), y)
+        else:
+            losses[spec] = F.mse_loss(o, y)
+    return sum(losses.values()) / max(len(losses), 1), losses
+
+def prepare_sequence_data(data_path, spec, batch_size = 512 ,batch_size_val = 512, frac_train = 0.7, frac_val = 0.1,
+                          bucket = False, max_tokens = None, lazy = False, batch_eval = False, split = None,
+                          num_workers = 1, seed = None, cache_dir = None):
+    """Load a data set and split it into train, validation and test data loaders for spec.
+
+    By default every design is padded to the longest design of the data set,
+    the training data is shuffled uniformly and the validation and test sets
+    are each a single batch. With bucket = True, training and validation
+    batches group designs of similar length (BucketBatchSampler) with
+    batch_size and batch_size_val designs or at most max_tokens padded tokens
+    per batch, the test batches keep the order of the test set, and every
+    batch is only padded to its own longest design.
+
+    With lazy = True a compact or sharded data set is kept as token records
+    (CompactSequenceData) and only expanded to dense rows per batch, in the
+    DataLoader workers (CompactCollate), and the validation and test sets are
+    split into batches of batch_size_val designs. batch_eval = True also
+    splits them into batches of batch_size_val designs for dense data.
+
+    spec may also be a list of specs, e.g. ssm.specs, for multi-task models:
+    the targets are then of shape [N, len(spec)], NaN where a design has no
+    valid target of a spec (see multi_task_targets), and scale_1 and scale_2
+    are dictionaries of the scales of each spec.
+
+    split = (train, val, test) gives the indices of the designs of each set,
+    into the designs with a valid target, instead of a random split, e.g. for
+    cross-validation folds. num_workers is the number of DataLoader worker
+    processes of each loader, 0 to load batches in the calling process.
+
+    With a seed, the split (and the batches of bucket) only depend on the
+    seed, not on the global random state. With a cache_dir as well, the
+    targets, split and padded rows are saved there the first time and loaded
+    on later calls with the same data set and options; the cache is keyed by
+    the size and modification time of the data set files, so it is rebuilt
+    when the data set changes.
+    """
+    assert frac_train + frac_val < 1.
     
+    if cache_dir is not None:
+        assert seed is not None, 'cached data needs a seed, so that the split is the same every time'
+        cache_path = prepared_cache_path(cache_dir, data_path, spec, frac_train, frac_val, seed, lazy)
+    prepared = None
+    if cache_dir is not None and os.path.exists(cache_path):
+        prepared = torch.load(cache_path, weights_only=False)
+
+    data = None
+    if prepared is None or 'X' not in prepared:
+        data = load_data(data_path)
+    if prepared is None:
+        prepared = prepare_sequence_arrays(data, spec, frac_train, frac_val, seed, lazy)
+        if cache_dir is not None:
+            save_prepared_cache(prepared, cache_path)
+
+    keep = prepared['keep']
+    lengths = prepared['lengths']
+    Y_norm = prepared['Y']
+    scale_1 = prepared['scale_1']
+    scale_2 = prepared['scale_2']
+    N = len(keep)
+
+    if 'X' not in prepared:
+        def dataset(indices):
+            return CompactSequenceData(data, keep[indices], Y_norm[indices])
+        collate_fn = CompactCollate(data.dic, seq_len=None if bucket else prepared['seq_len_max'])
+        full_batch = False
+    else:
+        X = prepared['X']
+
+        def dataset(indices):
+            return Data(X[indices], Y_norm[indices], lengths[indices])
+        collate_fn = trim_collate if bucket else length_collate
+        full_batch = not bucket and not batch_eval
+
+    def loader(indices, batch_size, shuffle):
+        data_set = dataset(indices)
+        if bucket and shuffle is not None:
+            sampler = BucketBatchSampler(lengths[indices], batch_size, max_tokens, shuffle=shuffle, seed=sampler_seed)
+            return DataLoader(data_set, batch_sampler=sampler, collate_fn=collate_fn, num_workers=num_workers)
+        if full_batch and not shuffle:
+            batch_size = len(data_set)
+        return DataLoader(data_set, batch_size=batch_size, shuffle=bool(shuffle), collate_fn=collate_fn, num_workers=num_workers)
+
     if frac_train == 0.0:
-        Y_norm = Y.float()
-        data_test = Data(X, Y_norm, src_mask)
-        dataloader_test = DataLoader(data_test, batch_size=len(data_test),
-                            shuffle=False, num_workers=1)
+        dataloader_test = loader(torch.arange(N), batch_size_val, shuffle=None)
         return dataloader_test, scale_1, scale_2
 
     else:
-        N_train = int(frac_train * N) # default: 70 %
-        N_val = int(frac_val * N) # default: 10 %
-
-        indices = torch.randperm(N)
-
-        Y_norm = Y.float()
-
-        data_tr = Data(X[indices[:N_train]], Y_norm[indices[:N_train]], src_mask[indices[:N_train]])
-        dataloader_tr = DataLoader(data_tr, batch_size=batch_size,
-                                shuffle=True, num_workers=1)
-        data_val = Data(X[indices[N_train:N_train+N_val]], Y_norm[indices[N_train:N_train+N_val]], src_mask[indices[N_train:N_train+N_val]])
-        dataloader_val = DataLoader(data_val, batch_size=len(data_val),
-                                shuffle=False, num_workers=1)
-        data_test = Data(X[indices[N_train+N_val:]], Y_norm[indices[N_train+N_val:]], src_mask[indices[N_train+N_val:]])
-        dataloader_test = DataLoader(data_test, batch_size=len(data_test),
-                                shuffle=False, num_workers=1)
+        if split is None:
+            split = prepared['split']
+        train_indices, val_indices, test_indices = [torch.as_tensor(i, dtype=torch.long) for i in split]
+        if seed is not None:
+            sampler_seed = seed
+        else:
+            sampler_seed = int(torch.randint(2**31, ())) if bucket else 0
+
+        # shuffle=None keeps the order of the set, also when bucketing
+        dataloader_tr = loader(train_indices, batch_size, shuffle=True)
+        dataloader_val = loader(val_indices, batch_size_val, shuffle=False)
+        dataloader_test = loader(test_indices, batch_size_val, shuffle=None)
     
     return dataloader_tr, dataloader_val, dataloader_test, scale_1, scale_2
 
+def prepare_sequence_arrays(data, spec, frac_train=0.7, frac_val=0.1, seed=None, lazy=False):
+    """Designs, targets, lengths and split of a data set for spec, and the
+    padded dense rows of the designs unless lazy, for prepare_sequence_data.
+
+    The split is drawn with torch.randperm, from a generator seeded with seed
+    if it is given.
+    """
+    if isinstance(data, CompactData):
+        dic = data.dic
+        lengths = data.lengths
+    else:
+        dic = data
+        lengths = torch.tensor([d.shape[0] for d in dic['X_norm']])
+    seq_len_max = lengths.max().item()
+
+    if isinstance(spec, str):
+        keep, Y, scale_1, scale_2 = sequence_targets(dic, spec)
+    else:
+        Y, valid, scale_1, scale_2 = multi_task_targets(dic, spec)
+        keep = torch.arange(len(Y))[valid.any(1)]
+        Y = Y[keep]
+    N = len(keep)
+
+    N_train = int(frac_train * N) # default: 70 %
+    N_val = int(frac_val * N) # default: 10 %
+    if frac_train == 0.0:
+        indices = torch.arange(N)
+    else:
+        generator = None if seed is None else torch.Generator().manual_seed(seed)
+        indices = torch.randperm(N, generator=generator)
+
+    prepared = {'keep': keep, 'Y': Y.float(), 'lengths': lengths[keep], 'seq_len_max': seq_len_max,
+                'scale_1': scale_1, 'scale_2': scale_2,
+                'split': (indices[:N_train], indices[N_train:N_train+N_val], indices[N_train+N_val:])}
+    if not (lazy and isinstance(data, CompactData)):
+        X_norm = data.dense(normalize=True) if isinstance(data, CompactData) else dic['X_norm']
+        prepared['X'] = torch.nn.utils.rnn.pad_sequence([X_norm[i] for i in keep.tolist()]).transpose(0,1) # padding sequences
+    return prepared
+
+PREPARED_CACHE_VERSION = 1
+
+def data_signature(data_path):
+    """Hash of the size and modification time of the files of a data set,
+    which changes whenever the data set is rebuilt."""
+    if os.path.isdir(data_path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(data_path) for name in names)
+    else:
+        paths = [data_path]
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        h.update('{}:{}:{};'.format(os.path.relpath(path, data_path), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()[:16]
+
+def prepared_cache_path(cache_dir, data_path, spec, frac_train, frac_val, seed, lazy):
+    """File of the cached prepare_sequence_arrays of a data set and its options.
+
+    The name is the hash of the data set path and options, then the
+    data_signature of the data set, so a rebuilt data set gets a new file.
+    """
+    options = json.dumps({'data_path': os.path.abspath(data_path), 'spec': spec, 'max_mass': max_mass,
+                          'frac_train': frac_train, 'frac_val': frac_val, 'seed': seed, 'lazy': lazy,
+                          'version': PREPARED_CACHE_VERSION}, sort_keys=True)
+    options_hash = hashlib.sha1(options.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}_{}.pt'.format(options_hash, data_signature(data_path)))
+
+def save_prepared_cache(prepared, cache_path):
+    """Save prepared arrays, and remove those of older versions of the same data set and options."""
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    options_hash = os.path.basename(cache_path).split('_')[0]
+    for name in os.listdir(cache_dir):
+        if name.startswith(options_hash + '_') and os.path.join(cache_dir, name) != cache_path:
+            os.remove(os.path.join(cache_dir, name))
+    tmp_path = cache_path + '.tmp'
+    torch.save(prepared, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+class TokenEmbedding(nn.Module):
+    """Input layer over token ids, equivalent to nn.Linear(D, d_model) over dense rows.
+
+    A dense row is [key one-hot, value one-hot, component attributes, float],
+    so its projection is the sum of a key embedding, a value embedding, a
+    projection of the component attributes and a projection of the float,
+    which are computed here without the D wide matmul. Takes the
+    (key_ids, value_ids, floats, comp_rows) of CompactCollate(output='ids').
+    """
+
+    def __init__(self, n_keys: int, n_values: int, comp_attrs: Tensor, d_model: int):
+        """
+        Args:
+            comp_attrs: normalized component attributes per component row, row 0 all zeros,
+                as 'comp_attrs_norm' of a compact data set.
+        """
+        super().__init__()
+        self.key_embedding = nn.Embedding(n_keys, d_model)
+        self.value_embedding = nn.Embedding(n_values, d_model)
+        self.comp_projection = nn.Linear(comp_attrs.shape[-1], d_model, bias=False)
+        self.float_projection = nn.Linear(1, d_model)
+        self.register_buffer('comp_attrs', comp_attrs.float())
+
+    @classmethod
+    def from_data(cls, dic, d_model):
+        """Token embedding for the vocabulary and component table of a compact data set."""
+        return cls(len(dic['encoding_dict_keys']), len(dic['encoding_dict_values']), dic['comp_attrs_norm'], d_model)
+
+    @classmethod
+    def from_linear(cls, linear, dic):
+        """Token embedding computing the same projection as a trained nn.Linear over dense rows."""
+        embedding = cls.from_data(dic, linear.out_features)
+        K, V, C = embedding.key_embedding.num_embeddings, embedding.value_embedding.num_embeddings, embedding.comp_attrs.shape[-1]
+        assert linear.in_features == K + V + C + 1, 'Linear layer does not match the layout of the data set'
+        weight = linear.weight.data
+        with torch.no_grad():
+            embedding.key_embedding.weight.copy_(weight[:, :K].t())
+            embedding.value_embedding.weight.copy_(weight[:, K:K + V].t())
+            embedding.comp_projection.weight.copy_(weight[:, K + V:K + V + C])
+            embedding.float_projection.weight.copy_(weight[:, -1:])
+            embedding.float_projection.bias.copy_(linear.bias.data)
+        return embedding
+
+    def init_weights(self, initrange):
+        for layer in [self.key_embedding, self.value_embedding, self.comp_projection, self.float_projection]:
+            layer.weight.data.uniform_(-initrange, initrange)
+
+    def forward(self, tokens, mask=None):
+        """
+        Args:
+            tokens: (key_ids, value_ids, floats, comp_rows), each of shape [batch_size, seq_len]
+            mask: padding mask, shape [batch_size, seq_len]. Padded positions
+                get the projection of an all zero row, as with dense rows.
+
+        Returns:
+            Tensor of shape [batch_size, seq_len, d_model]
+        """
+        key_ids, value_ids, floats, comp_rows = tokens
+        comp_table = self.comp_projection(self.comp_attrs)
+        x = self.key_embedding(key_ids) + self.value_embedding(value_ids) + comp_table[comp_rows]
+        if mask is not None:
+            x = x.masked_fill(mask.unsqueeze(-1), 0.)
+        return x + self.float_projection(floats.unsqueeze(-1))
+
+def use_token_embedding(model, dic):
+    """Replace the dense input layer of a trained TransformerModel or LSTM by
+    the equivalent TokenEmbedding, for the data set (or model encoding) dic it
+    was trained on. The model then takes token ids instead of dense rows."""
+    if isinstance(model, TransformerModel):
+        model.encoder = TokenEmbedding.from_linear(model.encoder, dic).to(model.encoder.weight.device)
+    else:
+        model.embedding = TokenEmbedding.from_linear(model.embedding, dic).to(model.embedding.weight.device)
+    return model
+
 class TransformerModel(nn.Module):
 
     def __init__(self, d_model: int, nhead: int, d_hid: int,
                  nlayers: int, dropout: float = 0.01, D: int = 741,
-                 D_out: int = 1): #dropout was 0.5
+                 D_out: int = 1, encoder: nn.Module = None, readout: str = 'padded'): #dropout was 0.5
+        """
+        Args:
+            encoder: input layer, default nn.Linear(D, d_model) over dense
+                rows. With a TokenEmbedding the model takes the token ids of
+                CompactCollate(output='ids') as input instead.
+            readout: 'padded' reads the output at the last position of the
+                padded batch, as the models of ModelBenchmark.ipynb, so the
+                padding changes the outputs. 'last' reads it at the last token
+                of each design given by src_mask, so bucketing and the padding
+                of a batch do not change them.
+        """
         super().__init__()
         
         self.D = D
         self.D_out = D_out
+        self.readout = readout
         self.model_type = 'Transformer'
         self.pos_encoder = PositionalEncoding(d_model, dropout)
         encoder_layers = TransformerEncoderLayer(d_model, nhead, d_hid, dropout)
         self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
-        self.encoder = nn.Linear(self.D, d_model)
+        self.encoder = nn.Linear(self.D, d_model) if encoder is None else encoder
         self.d_model = d_model
         self.decoder = nn.Linear(d_model, self.D_out)
 
@@ -136,7 +703,10 @@ class TransformerModel(nn.Module):
 
     def init_weights(self) -> None:
         initrange = 0.1
-        self.encoder.weight.data.uniform_(-initrange, initrange)
+        if isinstance(self.encoder, TokenEmbedding):
+            self.encoder.init_weights(initrange)
+        else:
+            self.encoder.weight.data.uniform_(-initrange, initrange)
         self.decoder.bias.data.zero_()
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
@@ -144,18 +714,58 @@ class TransformerModel(nn.Module):
         """
         Args:
             src: Tensor, shape [seq_len, batch_size]
-            src_mask: Tensor, shape [seq_len, seq_len]
+            src_mask: Tensor, shape [batch_size, seq_len], True at padded
+                positions (padding_mask)
 
         Returns:
-            output Tensor of shape [seq_len, batch_size, ntoken]
+            output Tensor of shape [batch_size, D_out]
         """
+        if isinstance(self.encoder, TokenEmbedding):
+            src = self.encoder(src, src_mask).permute(1, 0, 2) * math.sqrt(self.d_model)
+        else:
 #         Need to permute from B x SL x D to SL x B x D
-        src = self.encoder(src.permute(1, 0, 2)) * math.sqrt(self.d_model)
+            src = self.encoder(src.permute(1, 0, 2)) * math.sqrt(self.d_model)
         src = self.pos_encoder(src)
         output = self.transformer_encoder(src, src_key_padding_mask=src_mask)# #Don't use a mask here, we want to predict over whole sequence, src_mask)
-        output = self.decoder(output[-1])
+        if self.readout == 'padded' or src_mask is None:
+            output = output[-1]
+        else:
+            last = (~src_mask).sum(1) - 1
+            output = output[last, torch.arange(output.size(1), device=output.device)]
+        output = self.decoder(output)
         return output
 
+class MultiTaskHeads(nn.Module):
+    """One output head per spec on a shared representation.
+
+    Each head is a linear layer, or a small MLP with d_head hidden units. The
+    outputs are concatenated to shape [batch_size, len(task_specs)].
+    """
+
+    def __init__(self, d_in: int, task_specs=specs, d_head: int = None):
+        super().__init__()
+        self.task_specs = list(task_specs)
+        if d_head is None:
+            self.heads = nn.ModuleDict({spec: nn.Linear(d_in, 1) for spec in self.task_specs})
+        else:
+            self.heads = nn.ModuleDict({spec: nn.Sequential(nn.Linear(d_in, d_head), nn.ReLU(), nn.Linear(d_head, 1))
+                                        for spec in self.task_specs})
+
+    def forward(self, x: Tensor) -> Tensor:
+        return torch.cat([self.heads[spec](x) for spec in self.task_specs], -1)
+
+class MultiTaskTransformerModel(TransformerModel):
+    """TransformerModel with a shared encoder and one head per spec, predicting
+    all specs in one forward pass. Output shape [batch_size, len(task_specs)],
+    logits for classification specs."""
+
+    def __init__(self, d_model: int, nhead: int, d_hid: int,
+                 nlayers: int, dropout: float = 0.01, D: int = 741,
+                 task_specs=specs, d_head: int = None, encoder: nn.Module = None, readout: str = 'padded'):
+        super().__init__(d_model, nhead, d_hid, nlayers, dropout, D, len(task_specs), encoder, readout)
+        self.task_specs = list(task_specs)
+        self.decoder = MultiTaskHeads(d_model, task_specs, d_head)
+
 class PositionalEncoding(nn.Module):
 
     def __init__(self, d_model: int, dropout: float = 0.1, max_len: int = 5000):
@@ -183,11 +793,21 @@ def generate_square_subsequent_mask(sz: int) -> Tensor:
     
 class LSTM(nn.Module):
 
-    def __init__(self, D, emsize, dimension=128):
+    def __init__(self, D, emsize, dimension=128, embedding=None, packed=False):
+        """
+        Args:
+            embedding: input layer, default nn.Linear(D, emsize) over dense
+                rows, or a TokenEmbedding over token ids.
+            packed: if text_len is a tensor of lengths, run the LSTM over
+                packed sequences, skipping the padding. The reverse direction
+                then starts at the last token of each design instead of the
+                last padded position.
+        """
         super(LSTM, self).__init__()
 
-        self.embedding = nn.Linear(D, emsize)
+        self.embedding = nn.Linear(D, emsize) if embedding is None else embedding
         self.dimension = dimension
+        self.packed = packed
         self.lstm = nn.LSTM(input_size=emsize,
                             hidden_size=dimension,
                             num_layers=1,
@@ -199,15 +819,34 @@ class LSTM(nn.Module):
 
     def forward(self, text, text_len):
 
-        text_emb = self.embedding(text)
-
-        output, _ = self.lstm(text_emb)
-
-        out_forward = output[range(len(output)), text_len - 1, :self.dimension]
-        out_reverse = output[:, 0, self.dimension:]
-        out_reduced = torch.cat((out_forward, out_reverse), 1)
+        if isinstance(self.embedding, TokenEmbedding):
+            mask = padding_mask(text_len, text[0].shape[1]) if torch.is_tensor(text_len) else None
+            text_emb = self.embedding(text, mask)
+        else:
+            text_emb = self.embedding(text)
+
+        if self.packed and torch.is_tensor(text_len):
+            packed_emb = pack_padded_sequence(text_emb, text_len.cpu(), batch_first=True, enforce_sorted=False)
+            _, (h_n, _) = self.lstm(packed_emb)
+            # Final states: forward direction at the last token, reverse direction at the first token
+            out_reduced = torch.cat((h_n[0], h_n[1]), 1)
+        else:
+            output, _ = self.lstm(text_emb)
+
+            out_forward = output[torch.arange(output.size(0), device=output.device), text_len - 1, :self.dimension]
+            out_reverse = output[:, 0, self.dimension:]
+            out_reduced = torch.cat((out_forward, out_reverse), 1)
         text_fea = self.drop(out_reduced)
 
         text_out = self.fc(text_fea)
 
-        return text_out
\ No newline at end of file
+        return text_out
+
+class MultiTaskLSTM(LSTM):
+    """LSTM with one head per spec on the shared final states, predicting all
+    specs in one forward pass. Output shape [batch_size, len(task_specs)]."""
+
+    def __init__(self, D, emsize, dimension=128, task_specs=specs, d_head=None, embedding=None, packed=False):
+        super(MultiTaskLSTM, self).__init__(D, emsize, dimension, embedding, packed)
+        self.task_specs = list(task_specs)
+        self.fc = MultiTaskHeads(2*dimension, task_specs, d_head)
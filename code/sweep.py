@@ -0,0 +1,225 @@
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+import ssm
+from train import Trainer, build_model
+
+'''
+python sweep.py --data ../data_full/transformer_data_sharded --spec airworthy --results sweep_airworthy.csv --emsize 100,200 --d-hid 256,512 --nlayers 4,8 --dropout 0.1,0.2 --folds 5 --threads-per-worker 4
+'''
+
+# Hyperparameters of the sweep, columns of the results table
+sweep_params = ['emsize', 'd_hid', 'nlayers', 'nhead', 'dropout']
+# Settings of the run, also columns: a sweep only reuses the rows of a run with the same settings
+run_settings = ['spec', 'data', 'folds', 'seed', 'mode', 'packed', 'readout', 'epochs', 'patience', 'batch_size',
+                'batch_size_val', 'bucket', 'max_tokens', 'optimizer', 'lr', 'bf16']
+result_fields = run_settings + sweep_params + ['fold', 'best_val_loss', 'best_epoch', 'epochs_run', 'seconds', 'designs_per_sec', 'tokens_per_sec']
+
+
+def cv_folds(N, folds, seed=0):
+    """Split N designs into folds at random. Returns (train, val) indices of each fold."""
+    generator = torch.Generator().manual_seed(seed)
+    chunks = torch.randperm(N, generator=generator).chunk(folds)
+    return [(torch.cat([c for j, c in enumerate(chunks) if j != k]), chunks[k]) for k in range(folds)]
+
+def job_key(job):
+    return tuple(str(job[name]) for name in run_settings + sweep_params + ['fold'])
+
+def settings_of(args, specs):
+    """Values of the run_settings columns for the command line arguments, as strings."""
+    settings = {name: str(getattr(args, name)) for name in run_settings}
+    settings.update(spec=','.join(specs) if specs is not None else args.spec, data=os.path.abspath(args.data))
+    return settings
+
+def load_results(results_path):
+    """Rows of the results table, empty if it does not exist yet."""
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != result_fields:
+            raise ValueError('{} does not have the columns of this sweep.py, give another --results'.format(results_path))
+        return list(reader)
+
+def init_worker(threads):
+    # Each worker gets its own share of the cores, so the workers together do not oversubscribe them
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+def run_job(job):
+    """Train one configuration on one fold. Runs in a worker process.
+
+    The data set is a sharded data set, which every worker memory-maps, so
+    all workers share one copy of it in the page cache.
+    """
+    options = job['options']
+    torch.manual_seed(options.seed)
+    train_indices, val_indices = job['split']
+    dataloader_tr, dataloader_val, _, _, _ = ssm.prepare_sequence_data(
+        job['data_path'], job['specs'] or options.spec, batch_size=options.batch_size, batch_size_val=options.batch_size_val,
+        bucket=options.bucket, max_tokens=options.max_tokens, lazy=True,
+        split=(train_indices, val_indices, torch.zeros(0, dtype=torch.long)),
+        num_workers=0) # batches are expanded in the worker itself, within its thread budget
+
+    args = Namespace(**{name: job[name] for name in sweep_params}, mode=options.mode,
+                     specs=job['specs'], d_head=None, packed=options.packed,
+                     readout=options.readout)
+    model = build_model(args, dataloader_tr.dataset.data.D)
+    if options.optimizer == 'adam':
+        optimizer = torch.optim.Adam(model.parameters(), lr=options.lr)
+    else:
+        optimizer = torch.optim.SGD(model.parameters(), lr=options.lr)
+    trainer = Trainer(model, optimizer, job['specs'] or [options.spec], bf16=options.bf16)
+
+    start_time = time.time()
+    best_loss = float('inf')
+    best_epoch = 0
+    bad_epochs = 0
+    epoch = 0
+    throughput = []
+    while epoch < options.epochs and bad_epochs < options.patience:
+        epoch += 1
+        if hasattr(dataloader_tr.batch_sampler, 'set_epoch'):
+            dataloader_tr.batch_sampler.set_epoch(epoch)
+        _, epoch_throughput = trainer.train_epoch(dataloader_tr)
+        throughput.append(epoch_throughput)
+        val_loss = trainer.evaluate(dataloader_val)
+        if val_loss < best_loss:
+            best_loss, best_epoch, bad_epochs = val_loss, epoch, 0
+        else:
+            bad_epochs += 1
+
+    result = {name: job[name] for name in run_settings + sweep_params + ['fold']}
+    result.update({'best_val_loss': best_loss, 'best_epoch': best_epoch, 'epochs_run': epoch,
+                   'seconds': time.time() - start_time,
+                   'designs_per_sec': sum(t['designs_per_sec'] for t in throughput) / len(throughput),
+                   'tokens_per_sec': sum(t['tokens_per_sec'] for t in throughput) / len(throughput)})
+    return result
+
+def shared_data_path(data_path, cache_path):
+    """Path of a sharded copy of the data set, which workers can memory-map.
+
+    A sharded data set is used as is, a compact or dense one is converted
+    to cache_path, again whenever the data set changes.
+    """
+    if os.path.isdir(data_path):
+        return data_path
+    signature = ssm.data_signature(data_path)
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f).get('source_signature') == signature:
+                return cache_path
+        shutil.rmtree(cache_path)
+    from build_transformer_data import compact_from_dense, save_sharded
+    dic = torch.load(data_path, weights_only=False)
+    if dic.get('format') != 'compact':
+        dic = compact_from_dense(dic)
+    # Renamed when complete, so an interrupted conversion is never used
+    tmp_path = cache_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    save_sharded(dict(dic, source_signature=signature), tmp_path)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+def summarize(rows):
+    """Mean and standard deviation over the folds of the best validation loss of each configuration, best first."""
+    configs = {}
+    for row in rows:
+        configs.setdefault(tuple(row[name] for name in sweep_params), []).append(float(row['best_val_loss']))
+    summary = []
+    for config, losses in configs.items():
+        losses = torch.tensor(losses)
+        std = losses.std().item() if len(losses) > 1 else 0.
+        summary.append((losses.mean().item(), std, len(losses), config))
+    return sorted(summary)
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep with cross-validation over a process pool.')
+    parser.add_argument('--data', type=str, help='data set, e.g. "../data_full/transformer_data_sharded"; a dense or compact one is converted to a sharded copy next to --results')
+    parser.add_argument('--spec', type=str, help='target, or a comma separated list (or "all") for a multi-task model', default = 'airworthy')
+    parser.add_argument('--results', type=str, help='CSV results table. Configurations and folds already in it with the same settings are skipped, so an interrupted sweep can be rerun', default = 'sweep_results.csv')
+    parser.add_argument('--emsize', type=str, help='comma separated values of emsize', default = '200')
+    parser.add_argument('--d-hid', type=str, help='comma separated values of d_hid', default = '512')
+    parser.add_argument('--nlayers', type=str, help='comma separated values of nlayers', default = '8')
+    parser.add_argument('--nhead', type=str, help='comma separated values of nhead', default = '2')
+    parser.add_argument('--dropout', type=str, help='comma separated values of dropout', default = '0.2')
+    parser.add_argument('--folds', type=int, help='Number of cross-validation folds, at least 2', default = 5)
+    parser.add_argument('--seed', type=int, help='Random seed of the folds and the models', default = 0)
+    parser.add_argument('--mode', type=str, choices=['transformer', 'lstm'], help='model type', default = 'transformer')
+    parser.add_argument('--packed', help="Run the LSTM over packed sequences", action="store_true")
+    parser.add_argument('--readout', type=str, choices=['padded', 'last'], help='Position the transformer output is read at: the last padded position (as the notebook models) or the last token of each design, which makes it independent of the padding', default = 'padded')
+    parser.add_argument('--epochs', type=int, help='Maximum number of epochs', default = 100)
+    parser.add_argument('--patience', type=int, help='Stop after this many epochs without a lower validation loss', default = 10)
+    parser.add_argument('--batch-size', type=int, help='Number of designs per training batch', default = 512)
+    parser.add_argument('--batch-size-val', type=int, help='Number of designs per validation batch', default = 2048)
+    parser.add_argument('--bucket', help="Batch designs of similar length", action="store_true")
+    parser.add_argument('--max-tokens', type=int, help='With --bucket, maximum number of padded tokens per batch', default = None)
+    parser.add_argument('--optimizer', type=str, choices=['sgd', 'adam'], help='optimizer', default = 'sgd')
+    parser.add_argument('--lr', type=float, help='learning rate', default = 0.1)
+    parser.add_argument('--bf16', help="Run forward passes under bf16 autocast", action="store_true")
+    parser.add_argument('--threads-per-worker', type=int, help='Number of torch threads of each worker', default = 4)
+    parser.add_argument('--workers', type=int, help='Number of worker processes, default: cores / threads per worker', default = None)
+    args = parser.parse_args()
+    if args.folds < 2:
+        parser.error('--folds must be at least 2, every fold trains on the other folds')
+
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads_per_worker)
+    specs = None
+    if args.spec == 'all' or ',' in args.spec:
+        specs = ssm.specs if args.spec == 'all' else args.spec.split(',')
+    data_path = shared_data_path(args.data, os.path.splitext(args.results)[0] + '_data')
+
+    dic = ssm.load_data(data_path).dic
+    if specs is None:
+        N = len(ssm.sequence_targets(dic, args.spec)[0])
+    else:
+        N = int(ssm.multi_task_targets(dic, specs)[1].any(1).sum())
+    folds = cv_folds(N, args.folds, args.seed)
+
+    grid = itertools.product([int(v) for v in args.emsize.split(',')], [int(v) for v in args.d_hid.split(',')],
+                             [int(v) for v in args.nlayers.split(',')], [int(v) for v in args.nhead.split(',')],
+                             [float(v) for v in args.dropout.split(',')])
+    settings = settings_of(args, specs)
+    jobs = [dict(settings, **dict(zip(sweep_params, values)), fold=k, split=folds[k], data_path=data_path,
+                 specs=specs, options=args)
+            for values in grid for k in range(args.folds)]
+
+    # Rows of runs with other settings stay in the table, but are neither skipped nor summarized
+    rows = [row for row in load_results(args.results) if all(row[name] == value for name, value in settings.items())]
+    done = set(job_key(row) for row in rows)
+    todo = [job for job in jobs if job_key(job) not in done]
+    print('{} jobs, {} done, {} to run on {} workers with {} threads each'.format(
+        len(jobs), len(jobs) - len(todo), len(todo), workers, args.threads_per_worker))
+
+    new_table = not os.path.exists(args.results)
+    with open(args.results, 'a', newline='') as f, \
+         ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(args.threads_per_worker,)) as executor:
+        writer = csv.DictWriter(f, fieldnames=result_fields)
+        if new_table:
+            writer.writeheader()
+        futures = [executor.submit(run_job, job) for job in todo]
+        for future in as_completed(futures):
+            result = future.result()
+            writer.writerow(result)
+            f.flush()
+            rows.append({name: str(value) for name, value in result.items()})
+            print(' '.join('{}={}'.format(name, result[name]) for name in sweep_params + ['fold']),
+                  'val loss {:5.4f} at epoch {}'.format(result['best_val_loss'], result['best_epoch']))
+
+    print('{:>10s} {:>10s} {:>6s}  {}'.format('val loss', 'std', 'folds', ' '.join(sweep_params)))
+    for mean, std, n, config in summarize(rows):
+        print('{:10.4f} {:10.4f} {:6d}  {}'.format(mean, std, n, ' '.join(config)))
@@ -0,0 +1,21 @@
+from prediction_cache import design_key
+
+
+def design(tokens, name='design_1'):
+    return [{'generator_version': 'UAV2_gen12'}, {'name': name}] + tokens
+
+
+def test_design_key_ignores_name_and_number_type():
+    a = design([{'node_type': 'PropArm'}, {'armLength': 400}], 'design_1')
+    b = design([{'node_type': 'PropArm'}, {'armLength': 400.0}], 'design_2')
+    assert design_key(a) == design_key(b)
+
+def test_design_key_replaces_blacklisted_keys():
+    a = design([{'node_type': 'PropArm'}, {'arm1length': 400.0}, {'arm2length': 200.0}])
+    b = design([{'node_type': 'PropArm'}, {'arm1Length': 400.0}, {'arm2Length': 200.0}])
+    assert design_key(a) == design_key(b)
+
+def test_design_key_differs_by_value():
+    a = design([{'node_type': 'PropArm'}, {'armLength': 400.0}])
+    b = design([{'node_type': 'PropArm'}, {'armLength': 401.0}])
+    assert design_key(a) != design_key(b)
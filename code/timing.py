@@ -0,0 +1,78 @@
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+'''
+Stage-level wall/CPU timing, throughput and peak memory of a run, e.g. of
+the data build in build_transformer_data.py.
+'''
+
+
+def cpu_time():
+    """CPU time of this process and of its finished child processes (e.g. pool workers)."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+class StageTimer:
+    """Records the wall and CPU time of named stages of a run.
+
+    Usage:
+        timer = StageTimer()
+        with timer.stage('read'):
+            ...
+        report = timer.report(designs=N, tokens=T)
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_time()
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(name, {'wall': 0., 'cpu': 0.})
+            s['wall'] += time.perf_counter() - wall
+            s['cpu'] += cpu_time() - cpu
+
+    def report(self, designs=None, tokens=None, **extra):
+        """Summary of the run as a JSON serializable dictionary."""
+        wall = time.perf_counter() - self.start_wall
+        report = {'stages': self.stages,
+                  'total': {'wall': wall, 'cpu': cpu_time() - self.start_cpu},
+                  'peak_rss_mb': peak_rss_mb(),
+                  'peak_rss_children_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+        if designs is not None:
+            report['designs'] = designs
+            report['designs_per_sec'] = designs / wall
+        if tokens is not None:
+            report['tokens'] = tokens
+            report['tokens_per_sec'] = tokens / wall
+        report.update(extra)
+        return report
+
+    def print_report(self, report):
+        print('{:<12s} {:>10s} {:>10s}'.format('Stage', 'wall (s)', 'cpu (s)'))
+        for name, s in list(report['stages'].items()) + [('total', report['total'])]:
+            print('{:<12s} {:>10.3f} {:>10.3f}'.format(name, s['wall'], s['cpu']))
+        if 'designs' in report:
+            print('{} designs, {:.1f} designs/sec'.format(report['designs'], report['designs_per_sec']))
+        if 'tokens' in report:
+            print('{} tokens, {:.1f} tokens/sec'.format(report['tokens'], report['tokens_per_sec']))
+        print('Peak RSS {:.1f} MB, child processes {:.1f} MB'.format(report['peak_rss_mb'], report['peak_rss_children_mb']))
+
+    def save_report(self, report, path):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,219 @@
+import argparse
+import math
+import os
+import time
+
+import torch
+
+import ssm
+
+'''
+python train.py --data ../data/transformer_data --spec airworthy --save-path ../models/transformer_airworthy --epochs 300 --threads 16 --bf16
+'''
+
+
+def build_model(args, D):
+    """Model of the command line arguments, as in ModelBenchmark.ipynb."""
+    if args.specs is not None:
+        if args.mode == 'lstm':
+            return ssm.MultiTaskLSTM(D, args.emsize, args.d_hid, args.specs, args.d_head, packed=args.packed)
+        return ssm.MultiTaskTransformerModel(args.emsize, args.nhead, args.d_hid, args.nlayers, args.dropout, D,
+                                             args.specs, args.d_head, readout=args.readout)
+    if args.mode == 'lstm':
+        return ssm.LSTM(D, args.emsize, args.d_hid, packed=args.packed)
+    return ssm.TransformerModel(args.emsize, args.nhead, args.d_hid, args.nlayers, args.dropout, D, 1, readout=args.readout)
+
+def save_atomic(obj, path):
+    """torch.save to a temporary file and rename it, so an interrupted run never leaves a partial file."""
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class Trainer:
+    """Trains a TransformerModel or LSTM (or a multi-task model) on the data
+    loaders of ssm.prepare_sequence_data.
+
+    Supports gradient accumulation, bf16 autocast and per-epoch throughput
+    (designs/sec, tokens/sec). The loss of a single spec is that of
+    ModelBenchmark.ipynb: binary cross entropy for 'airworthy' and
+    'interference', mean squared error otherwise.
+    """
+
+    def __init__(self, model, optimizer, task_specs, device='cpu', accumulate=1, bf16=False, clip=0.5):
+        self.model = model
+        self.optimizer = optimizer
+        self.task_specs = task_specs
+        self.device = torch.device(device)
+        self.accumulate = accumulate
+        self.bf16 = bf16
+        self.clip = clip
+        self.lstm = isinstance(model, ssm.LSTM)
+
+    def loss(self, x, y, mask, lengths):
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            if self.lstm:
+                output = self.model(x.to(self.device), lengths.to(self.device))
+            else:
+                output = self.model(x.to(self.device), mask.to(self.device))
+        loss, _ = ssm.multi_task_loss(output.float(), y.view(len(y), -1).to(self.device), self.task_specs)
+        return loss
+
+    def train_epoch(self, dataloader):
+        """One epoch over dataloader. Returns the mean loss and the throughput."""
+        self.model.train()
+        total_loss = 0.
+        num_batches = 0
+        designs = 0
+        tokens = 0
+        start_time = time.time()
+        self.optimizer.zero_grad()
+        for batch, (x, y, mask, lengths) in enumerate(dataloader):
+            loss = self.loss(x, y, mask, lengths)
+            (loss / self.accumulate).backward()
+            if (batch + 1) % self.accumulate == 0:
+                self.step()
+            total_loss += loss.item()
+            num_batches += 1
+            designs += len(lengths)
+            tokens += int(lengths.sum())
+        if num_batches % self.accumulate != 0:
+            self.step()
+        elapsed = time.time() - start_time
+        return total_loss / num_batches, {'designs_per_sec': designs / elapsed, 'tokens_per_sec': tokens / elapsed}
+
+    def step(self):
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+
+    def evaluate(self, dataloader):
+        """Mean loss over dataloader, weighted by the number of designs per batch."""
+        self.model.eval()
+        total_loss = 0.
+        designs = 0
+        with torch.inference_mode():
+            for x, y, mask, lengths in dataloader:
+                total_loss += self.loss(x, y, mask, lengths).item() * len(lengths)
+                designs += len(lengths)
+        return total_loss / designs
+
+
+# Main code
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train a sequence model on a data set built by build_transformer_data.py.')
+    parser.add_argument('--data', type=str, help='data set, e.g. "../data/transformer_data"')
+    parser.add_argument('--spec', type=str, help='target: airworthy, interference, mass, dist or hover, or a comma separated list (or "all") for a multi-task model', default = 'airworthy')
+    parser.add_argument('--save-path', type=str, help='prefix of the saved files: <save-path>_model_config holds the config and best weights, <save-path>_checkpoint the last epoch')
+    parser.add_argument('--mode', type=str, choices=['transformer', 'lstm'], help='model type', default = 'transformer')
+    parser.add_argument('--emsize', type=int, help='embedding dimension', default = 200)
+    parser.add_argument('--d-hid', type=int, help='dimension of the feedforward network of the transformer, hidden size of the LSTM', default = 512)
+    parser.add_argument('--nlayers', type=int, help='number of transformer encoder layers', default = 8)
+    parser.add_argument('--nhead', type=int, help='number of attention heads', default = 2)
+    parser.add_argument('--dropout', type=float, help='dropout probability', default = 0.2)
+    parser.add_argument('--d-head', type=int, help='hidden units of the heads of a multi-task model, default: linear heads', default = None)
+    parser.add_argument('--packed', help="Run the LSTM over packed sequences", action="store_true")
+    parser.add_argument('--readout', type=str, choices=['padded', 'last'], help='Position the transformer output is read at: the last padded position (as the notebook models) or the last token of each design, which makes it independent of the padding', default = 'padded')
+    parser.add_argument('--batch-size', type=int, help='Number of designs per training batch', default = 512)
+    parser.add_argument('--batch-size-val', type=int, help='Number of designs per validation batch', default = 2048)
+    parser.add_argument('--frac-train', type=float, help='Fraction of the designs used for training', default = 0.7)
+    parser.add_argument('--frac-val', type=float, help='Fraction of the designs used for validation', default = 0.1)
+    parser.add_argument('--bucket', help="Batch designs of similar length, padded to the longest design of each batch", action="store_true")
+    parser.add_argument('--max-tokens', type=int, help='With --bucket, maximum number of padded tokens per batch instead of --batch-size designs', default = None)
+    parser.add_argument('--lazy', help="Keep a compact or sharded data set as token records and expand each batch when it is used", action="store_true")
+    parser.add_argument('--cache-dir', type=str, help='Cache the prepared data set and split here, see ssm.prepare_sequence_data', default = None)
+    parser.add_argument('--epochs', type=int, help='Maximum number of epochs', default = 300)
+    parser.add_argument('--patience', type=int, help='Stop after this many epochs without a lower validation loss', default = 20)
+    parser.add_argument('--optimizer', type=str, choices=['sgd', 'adam'], help='optimizer', default = 'sgd')
+    parser.add_argument('--lr', type=float, help='learning rate', default = 0.1)
+    parser.add_argument('--accumulate', type=int, help='Number of batches to accumulate gradients over per optimizer step', default = 1)
+    parser.add_argument('--bf16', help="Run forward passes under bf16 autocast", action="store_true")
+    parser.add_argument('--threads', type=int, help='Number of torch threads, default: torch default', default = None)
+    parser.add_argument('--device', type=str, help='Device to train on, e.g. "cpu" or "cuda:0"', default = 'cpu')
+    parser.add_argument('--seed', type=int, help='Random seed of the data split and the model', default = 0)
+    parser.add_argument('--resume', help="Continue from <save-path>_checkpoint if it exists", action="store_true")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    args.specs = None
+    if args.spec == 'all' or ',' in args.spec:
+        args.specs = ssm.specs if args.spec == 'all' else args.spec.split(',')
+    task_specs = args.specs if args.specs is not None else [args.spec]
+    config_path = args.save_path + '_model_config'
+    checkpoint_path = args.save_path + '_checkpoint'
+
+    torch.manual_seed(args.seed)
+    dataloader_tr, dataloader_val, dataloader_test, scale_1, scale_2 = ssm.prepare_sequence_data(
+        args.data, task_specs if args.specs is not None else args.spec, batch_size=args.batch_size,
+        batch_size_val=args.batch_size_val, frac_train=args.frac_train, frac_val=args.frac_val, bucket=args.bucket,
+        max_tokens=args.max_tokens, lazy=args.lazy, batch_eval=True, seed=args.seed, cache_dir=args.cache_dir)
+    x, _, _, _ = next(iter(dataloader_val))
+    D = x.shape[-1]
+
+    model = build_model(args, D).to(args.device)
+    if args.optimizer == 'adam':
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    else:
+        optimizer = torch.optim.SGD(model.parameters(), lr=args.lr)
+    trainer = Trainer(model, optimizer, task_specs, args.device, args.accumulate, args.bf16)
+
+    config = {'emsize': args.emsize, 'd_hid': args.d_hid, 'nlayers': args.nlayers, 'nhead': args.nhead,
+              'dropout': args.dropout, 'D': D, 'D_out': len(task_specs), 'mode': args.mode, 'packed': args.packed,
+              'readout': args.readout, 'scale_1': scale_1, 'scale_2': scale_2,
+              # Padded length of the batches, 0 if each batch is padded to its longest design
+              'seq_len': 0 if args.bucket else x.shape[1]}
+    if args.specs is not None:
+        config.update({'specs': task_specs, 'd_head': args.d_head})
+    else:
+        config['spec'] = args.spec
+
+    state = {'epoch': 0, 'best_loss': float('inf'), 'bad_epochs': 0, 'loss_list': [], 'val_loss_list': [], 'history': []}
+    if args.resume and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, weights_only=False)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        torch.set_rng_state(checkpoint['rng_state'])
+        state = checkpoint['state']
+        print('Resuming after epoch {}'.format(state['epoch']))
+
+    while state['epoch'] < args.epochs and state['bad_epochs'] < args.patience:
+        epoch = state['epoch'] + 1
+        if hasattr(dataloader_tr.batch_sampler, 'set_epoch'):
+            dataloader_tr.batch_sampler.set_epoch(epoch)
+        epoch_start_time = time.time()
+        loss, throughput = trainer.train_epoch(dataloader_tr)
+        val_loss = trainer.evaluate(dataloader_val)
+        elapsed = time.time() - epoch_start_time
+        print('-' * 89)
+        print(f'| end of epoch {epoch:3d} | time: {elapsed:5.2f}s | '
+              f'loss {loss:5.4f} | '
+              f'val loss {val_loss:5.4f} | '
+              f'{throughput["designs_per_sec"]:.1f} designs/sec | {throughput["tokens_per_sec"]:.1f} tokens/sec')
+        print('-' * 89)
+        if math.isnan(val_loss):
+            print('Stopping, the validation loss is NaN')
+            break
+
+        state['epoch'] = epoch
+        state['loss_list'].append(loss)
+        state['val_loss_list'].append(val_loss)
+        state['history'].append(dict(throughput, epoch=epoch, loss=loss, val_loss=val_loss, time=elapsed))
+        if val_loss < state['best_loss']:
+            state['best_loss'] = val_loss
+            state['bad_epochs'] = 0
+            save_atomic(dict(config, state_dict=model.state_dict(), epoch=epoch, val_loss=val_loss), config_path)
+        else:
+            state['bad_epochs'] += 1
+        save_atomic({'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                     'rng_state': torch.get_rng_state(), 'state': state, 'args': vars(args)}, checkpoint_path)
+
+    if state['best_loss'] == float('inf'):
+        raise SystemExit('No epoch gave a finite validation loss, {} was not saved'.format(config_path))
+    # Keep the loss curves with the best weights, as in the notebook's model configs
+    best = torch.load(config_path, weights_only=False)
+    best.update(loss_list=state['loss_list'], val_loss_list=state['val_loss_list'], history=state['history'])
+    save_atomic(best, config_path)
+    model.load_state_dict(best['state_dict'])
+    print('Best val loss {:5.4f} at epoch {}, test loss {:5.4f}'.format(best['val_loss'], best['epoch'],
+                                                                        trainer.evaluate(dataloader_test)))
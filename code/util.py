@@ -4,7 +4,8 @@ import itertools
 from stl import mesh
 from mpl_toolkits import mplot3d
 import os
-import json
+import design_io
+from design_archive import DesignArchive
 
 def plot_confusion_matrix(cm,
                           target_names,
@@ -89,7 +90,10 @@ def plot_stl(path = None, design = None):
     axes = figure.add_subplot(111, projection="3d")#, elev=elev, azim=azim)
 
     # Load the STL files and add the vectors to the plot
-    your_mesh = mesh.Mesh.from_file(os.path.join(os.path.join(path,design), 'cadfile.stl'))
+    if isinstance(path, DesignArchive):
+        your_mesh = path.load_stl(design)
+    else:
+        your_mesh = mesh.Mesh.from_file(os.path.join(os.path.join(path,design), 'cadfile.stl'))
     
     your_mesh.vectors[:,:,-1] = -your_mesh.vectors[:,:,-1]
     
@@ -104,8 +108,17 @@ def plot_stl(path = None, design = None):
     plt.show()
     # return your_mesh.vectors
 
+def load_npy(path, design, name):
+    """Load an npy file of a design from a dataset folder, or from a DesignArchive."""
+    if isinstance(path, DesignArchive):
+        return path.load_npy(design, name)
+    return np.load(os.path.join(os.path.join(path,design), name))
+
+def load_trims(path, design):
+    return load_npy(path, design, 'trims.npy')
+
 def plot_pointCloud(path, design):
-    pc = np.load(os.path.join(os.path.join(path,design), 'pointCloud.npy'))
+    pc = load_npy(path, design, 'pointCloud.npy')
     
     fig = plt.figure(figsize=(12,7))
     ax = fig.add_subplot(projection='3d')
@@ -173,12 +186,16 @@ def plot_trim_stats(vel_array, names, fs = 14, figsize=(10, 2)):
     
     
 def collect_design_parts(path, design):
-    lowlevel = open(os.path.join(os.path.join(path,design), 'design_low_level.json'))
-    lowlevel_json = json.load(lowlevel)
-    lowlevel_json_print = json.dumps(lowlevel_json, indent=4)
-    lowlevel.close()
-    parts = [part['component_type'] for part in lowlevel_json['components']]
-    return parts
+    return collect_many_design_parts(path, [design])[0]
+
+def collect_many_design_parts(path, designs):
+    """Component types of the low level design of each design, path may be a DesignArchive."""
+    lowlevel_jsons = design_io.read_many(designs, 'low_level', path)
+    for design, lowlevel_json in zip(designs, lowlevel_jsons):
+        if lowlevel_json is None:
+            design_path = os.path.join(path, design) if isinstance(path, str) else design
+            raise FileNotFoundError('No {} in {}'.format(design_io.kinds['low_level'], design_path))
+    return [[part['component_type'] for part in lowlevel_json['components']] for lowlevel_json in lowlevel_jsons]
 
 def count(string, Y):
     count_list = []
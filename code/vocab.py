@@ -0,0 +1,98 @@
+import hashlib
+import json
+
+'''
+Deterministic vocabulary of the sequence keys and values.
+
+Token ids only depend on the words, not on the order they were seen in or on
+string hash randomization, and a saved vocabulary can be extended with new
+words without renumbering, so encoded data and trained models stay valid
+across builds.
+'''
+
+VOCAB_FORMAT_VERSION = 1
+FLOAT_VALUE = 'Value' # Value token of float tokens
+
+
+class Vocabulary:
+    """Encoding dictionaries of sequence keys and values.
+
+    Args:
+        encoding_dict_keys: key -> id, ids 0..K-1.
+        encoding_dict_values: value -> id, ids 0..V-1, including 'Value'.
+        revision: number of times the vocabulary was extended.
+    """
+
+    def __init__(self, encoding_dict_keys, encoding_dict_values, revision=0):
+        self.encoding_dict_keys = dict(encoding_dict_keys)
+        self.encoding_dict_values = dict(encoding_dict_values)
+        self.revision = revision
+        assert sorted(self.encoding_dict_keys.values()) == list(range(len(self.encoding_dict_keys)))
+        assert sorted(self.encoding_dict_values.values()) == list(range(len(self.encoding_dict_values)))
+
+    @classmethod
+    def build(cls, keys, values):
+        """Vocabulary of the string keys and values, sorted, with 'Value' as the last value."""
+        keys = sorted(set(k for k in keys if isinstance(k, str)))
+        values = sorted(set(v for v in values if isinstance(v, str) and v != FLOAT_VALUE)) + [FLOAT_VALUE]
+        return cls({k: i for i, k in enumerate(keys)}, {v: i for i, v in enumerate(values)})
+
+    def extend(self, keys, values):
+        """Append the keys and values that are not in the vocabulary yet, in sorted order.
+
+        Existing ids do not change. Returns the list of new words.
+        """
+        new_words = []
+        for encoding_dict, words in [(self.encoding_dict_keys, keys), (self.encoding_dict_values, values)]:
+            new = sorted(set(w for w in words if isinstance(w, str) and w not in encoding_dict))
+            for w in new:
+                encoding_dict[w] = len(encoding_dict)
+            new_words.extend(new)
+        if new_words:
+            self.revision += 1
+        return new_words
+
+    def extends(self, other):
+        """True if every word of other has the same id in this vocabulary."""
+        return (all(self.encoding_dict_keys.get(k) == i for k, i in other.encoding_dict_keys.items()) and
+                all(self.encoding_dict_values.get(v) == i for v, i in other.encoding_dict_values.items()))
+
+    @property
+    def keys(self):
+        return sorted(self.encoding_dict_keys, key=self.encoding_dict_keys.get)
+
+    @property
+    def values(self):
+        return sorted(self.encoding_dict_values, key=self.encoding_dict_values.get)
+
+    def fingerprint(self):
+        """Hash of the words and their ids, to tie encoded data and models to a vocabulary."""
+        content = json.dumps([self.keys, self.values]).encode()
+        return hashlib.sha1(content).hexdigest()[:16]
+
+    def state_dict(self):
+        return {'format_version': VOCAB_FORMAT_VERSION, 'revision': self.revision,
+                'fingerprint': self.fingerprint(), 'keys': self.keys, 'values': self.values}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.state_dict(), f, indent=1)
+
+    @classmethod
+    def from_state_dict(cls, state):
+        if state['format_version'] > VOCAB_FORMAT_VERSION:
+            raise ValueError('Vocabulary format version {} is newer than {}'.format(state['format_version'], VOCAB_FORMAT_VERSION))
+        vocab = cls({k: i for i, k in enumerate(state['keys'])}, {v: i for i, v in enumerate(state['values'])}, state['revision'])
+        if vocab.fingerprint() != state['fingerprint']:
+            raise ValueError('Vocabulary fingerprint does not match its contents')
+        return vocab
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_state_dict(json.load(f))
+
+    @classmethod
+    def from_data(cls, dic):
+        """Vocabulary of a data set or model encoding dictionary with 'encoding_dict_keys' and 'encoding_dict_values'."""
+        return cls(dic['encoding_dict_keys'], dic['encoding_dict_values'])